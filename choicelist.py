@@ -5,6 +5,12 @@ from modeline import Modeline
 
 import pygame
 
+def show(choices, modelinetext=''):
+    """Open a ChoiceList once the UI update has released the lock."""
+    screen.defer(lambda: screen.stack.append(ChoiceList(choices,
+                                                        modelinetext)))
+
+
 class ChoiceList(screen.Screen):
     SCROLL_WIDTH = 25
     ITEM_HEIGHT = 25
@@ -28,14 +34,14 @@ class ChoiceList(screen.Screen):
             self.rects.append(rect)
             pygame.draw.rect(self.listsurface, gui.C_PRIMARY, rect, 1)
             if type(choice) is list:
-                text = self.font.render(choice[0], False, gui.C_DARKER)
+                text = gui.render_text(self.font, choice[0], gui.C_DARKER)
             else:
-                text = self.font.render(choice, False, gui.C_DARKER)
+                text = gui.render_text(self.font, choice, gui.C_DARKER)
             # FIX: Pseudo centering
             self.listsurface.blit(text, (4, i * self.ITEM_HEIGHT + 7))
 
     def _update(self, events):
-        self.has_changed = True
+        self.has_changed = screen.has_input(events)
         for e in events:
             if e.type == pygame.MOUSEBUTTONDOWN:
                 x, y = e.pos
@@ -10,7 +10,7 @@ import editors
 import midi
 
 from modeline import Modeline
-from choicelist import ChoiceList
+import choicelist
 from gui import ActionButton, TextField, Counter
 
 SPACE = 5
@@ -58,6 +58,12 @@ class ClipSettings(screen.Screen):
                                        BUTTON_HEIGHT,
                                        'Channel', 1, 16,
                                        channel)
+        port = clip.part.port + 1 if clip else 1
+        # A part may use a port that isn't configured, which is kept
+        self.port_counter = Counter((300, ypos),
+                                    BUTTON_HEIGHT,
+                                    'Port', 1, max(1, len(midi.ports), port),
+                                    port)
 
         ypos += SPACE + BUTTON_HEIGHT
         bank = clip.part.bank if clip else 0
@@ -90,42 +96,56 @@ class ClipSettings(screen.Screen):
         self.editor_gui = clip.clipsettings_gui(instance=clip) if clip else ()
 
     def _update(self, events):
-        self.has_changed = True
+        self.has_changed = screen.has_input(events)
         self.name_field.update(events)
         self.channel_counter.update(events)
+        self.port_counter.update(events)
         self.measures_counter.update(events)
         if self.bank_counter.update(events) and not self.new:
             part = self.clip.part
             bank = self.bank_counter.value
             program = self.program_counter.value
             if bank > 0 and program > 0:
-                midi.out.write_short(midi.CC + part.channel, 32, bank - 1)
-                midi.out.write_short(midi.PC + part.channel, program - 1)
+                midi.write([midi.CC + part.channel, 32, bank - 1],
+                           port=part.port)
+                midi.write([midi.PC + part.channel, program - 1],
+                           port=part.port)
         if self.program_counter.update(events) and not self.new:
             part = self.clip.part
             program = self.program_counter.value
             if program > 0:
-                midi.out.write_short(midi.PC + part.channel, program - 1)
+                midi.write([midi.PC + part.channel, program - 1],
+                           port=part.port)
         if self.clip is None and self.editor_button.clicked(events):
-            screen.stack.append(ChoiceList(editors.editors, 'Editor'))
+            choicelist.show(editors.editors, 'Editor')
         if self.clip is None and self.instrument_button.clicked(events):
-            screen.stack.append(ChoiceList(instruments, 'Instrument'))
+            choicelist.show(instruments, 'Instrument')
 
         for widget in self.editor_gui:
             widget.update(events)
 
     def _render_button(self, surface, button, text):
-        text = self.font.render(text, False, gui.C_DARKER)
+        text = gui.render_text(self.font, text, gui.C_DARKER)
         x = button.rect.x
         y = button.rect.centery - text.get_rect().height / 2
         width = button.rect.width
         surface.blit(text, (x + width + SPACE, y))
         button.render(surface)
 
+    def _render_port_missing(self, surface):
+        text = gui.render_text(self.font, 'Missing', gui.C_DARKER)
+        rect = self.port_counter.inc.rect
+        y = rect.centery - text.get_rect().height / 2
+        surface.blit(text, (rect.right + SPACE, y))
+
     def _render(self, surface):
         self.instrument_button.render(surface)
         self.name_field.render(surface)
         self.channel_counter.render(surface)
+        self.port_counter.render(surface)
+        port = self.port_counter.value - 1
+        if port >= len(midi.ports) or not midi.ports[port].output:
+            self._render_port_missing(surface)
         self.bank_counter.render(surface)
         self.program_counter.render(surface)
         self.measures_counter.render(surface)
@@ -150,6 +170,10 @@ class ClipSettings(screen.Screen):
                 self.name_field.text = value
             elif key == 'channel':
                 self.channel_counter.value = value
+            elif key == 'port':
+                self.port_counter.maximum = max(self.port_counter.maximum,
+                                                value)
+                self.port_counter.value = value
             elif key == 'program':
                 self.program_counter.value = value
             elif key == 'bank':
@@ -175,6 +199,7 @@ class ClipSettings(screen.Screen):
             return
 
         channel = self.channel_counter.value - 1
+        port = self.port_counter.value - 1
         bank = self.bank_counter.value
         program = self.program_counter.value
         if self.new:
@@ -182,19 +207,22 @@ class ClipSettings(screen.Screen):
                                                  channel,
                                                  self.measures_counter.value,
                                                  self.editor_gui)
+            clip.part.port = port
             clip.part.bank = bank
             clip.part.program = program
             if self.cc is not None:
                 clip.part.cc = self.cc
             if bank > 0:
-                midi.out.write_short(midi.CC + channel, 32, bank - 1)
+                midi.write([midi.CC + channel, 32, bank - 1], port=port)
             if program > 0:
-                midi.out.write_short(midi.PC + channel, program - 1)
+                midi.write([midi.PC + channel, program - 1], port=port)
             sequencer.scene().append(clip)
+            sequencer.invalidate()
         else:
             self.clip.clipsettings_update(self.name_field.text,
                                           channel,
                                           self.measures_counter.value,
                                           self.editor_gui)
+            self.clip.part.port = port
             self.clip.part.bank = bank
             self.clip.part.program = program
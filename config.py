@@ -1,13 +1,16 @@
 import yaml
 
-import pygame.midi as pm
-
 import screen
 import midi
 import sequencer
 
 from gui import Counter, ActionButton
-from choicelist import ChoiceList
+import choicelist
+
+
+def save_config(config_dict):
+    with file('config.yml', 'w') as stream:
+        yaml.dump(config_dict, stream)
 
 
 class ConfigScreen(screen.Screen):
@@ -21,8 +24,7 @@ class ConfigScreen(screen.Screen):
 
         midi_in = 'Midi In: None'
         if midi.m_in:
-            name = pm.get_device_info(midi.m_in.device_id)[1]
-            midi_in = 'Midi In: {}'.format(name)
+            midi_in = 'Midi In: {}'.format(midi.in_name)
         self.midi_in_button = ActionButton((SPACE, ypos),
                                            BUTTON_S,
                                            midi_in,
@@ -34,8 +36,7 @@ class ConfigScreen(screen.Screen):
         ypos += SPACE + BUTTON_H
         midi_out = 'Midi Out: None'
         if midi.out:
-            name = pm.get_device_info(midi.out.device_id)[1]
-            midi_out = 'Midi Out: {}'.format(name)
+            midi_out = 'Midi Out: {}'.format(midi.ports[0].name)
         self.midi_out_button = ActionButton((SPACE, ypos),
                                             BUTTON_S,
                                             midi_out,
@@ -47,16 +48,28 @@ class ConfigScreen(screen.Screen):
                                    'BPM', 20, 320,
                                    start=sequencer.project['bpm'])
 
+        ypos += SPACE + BUTTON_H
+        self.clock_modes = ['send', 'receive', 'none']
+        self.clock_mode = midi.config.get('midi_clock', 'send')
+        self.clock_button = ActionButton((SPACE, ypos),
+                                         BUTTON_S,
+                                         'Midi Clock: ' + self.clock_mode,
+                                         True, True)
+
     def _update(self, events):
-        self.has_changed = True
+        self.has_changed = screen.has_input(events)
         if self.midi_in_button.update(events):
             devices = [[od[0], od[0]] for od in midi.inDevices()]
-            screen.stack.append(ChoiceList(devices, 'In Device'))
+            choicelist.show(devices, 'In Device')
         self.channel_counter.update(events)
         if self.midi_out_button.update(events):
             devices = [[od[0], od[0]] for od in midi.outDevices()]
-            screen.stack.append(ChoiceList(devices, 'Out Device'))
+            choicelist.show(devices, 'Out Device')
         self.bpm_counter.update(events)
+        if self.clock_button.update(events):
+            i = self.clock_modes.index(self.clock_mode) + 1
+            self.clock_mode = self.clock_modes[i % len(self.clock_modes)]
+            self.clock_button.text = 'Midi Clock: ' + self.clock_mode
 
     def focus(self, *args, **kwargs):
         if 'in_device' in kwargs:
@@ -70,23 +83,21 @@ class ConfigScreen(screen.Screen):
 
     def close(self):
         sequencer.project['bpm'] = self.bpm_counter.value
+        sequencer.midiclock = sequencer.MC_NAMES[self.clock_mode]
         midi.in_channel = self.channel_counter.value
-        in_name = None
-        out_name = None
-        if midi.m_in:
-            in_name = pm.get_device_info(midi.m_in.device_id)[1]
-        if midi.out:
-            out_name = pm.get_device_info(midi.out.device_id)[1]
-        config_dict = {'midi_out': out_name,
-                       'midi_in': in_name,
-                       'midi_in_channel': midi.in_channel}
-        stream = file('config.yml', 'w')
-        yaml.dump(config_dict, stream)
+        config_dict = dict(midi.config)
+        config_dict.update({'midi_out': midi.ports[0].wanted,
+                            'midi_in': midi.wanted_in,
+                            'midi_in_channel': midi.in_channel,
+                            'midi_clock': self.clock_mode})
+        midi.config = config_dict
+        screen.defer(save_config, config_dict)
 
     def _render(self, surface):
         self.midi_in_button.render(surface)
         self.channel_counter.render(surface)
         self.midi_out_button.render(surface)
         self.bpm_counter.render(surface)
+        self.clock_button.render(surface)
 
         return surface
@@ -1,71 +1,166 @@
 import sequencer
 import midi
 
+import yaml
+
+# Event kinds
+NOTE_ON = 0
+NOTE_OFF = 1
+CC = 2
 
-class Event(object):
-    def __init__(self, timestamp, function, params):
-        # Using __dict__ directly to override __setattr__
-        self.__dict__['timestamp'] = timestamp
-        self.__dict__['function'] = function
-        self.__dict__['params'] = params
 
-    def type(self):
-        return self.function.__name__
+class Event(object):
+    """Abstract base class of events.
+
+    Each kind of event is a subclass with its data in __slots__, listed in
+    fields. The timestamp is measured in 16ths, and tick is the timestamp
+    converted to ticks.
+    """
+    __slots__ = ('_timestamp', 'tick')
+    kind = None
+    name = None
+    fields = ()
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+    @classmethod
+    def at_tick(cls, tick, *args):
+        """Create an event at an absolute song position in ticks."""
+        return cls(tick / float(sequencer.TICKS_PER_STEP), *args)
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = value
+        self.tick = sequencer.to_ticks(value)
+
+    def params(self):
+        return [getattr(self, field) for field in self.fields]
+
+    def copy(self, timestamp=None):
+        """Return a copy of the event, optionally with a new timestamp."""
+        if timestamp is None:
+            timestamp = self.timestamp
+        return self.__class__(timestamp, *self.params())
 
     def call(self, part):
-        self.function(part, *self.params)
+        """Trigger the event for part."""
+        pass
 
     def __repr__(self):
         return 'Event({}, {}, {})'.format(self.timestamp,
-                                          self.type(),
-                                          self.params)
-
-    def __getattr__(self, name):
-        # Checks if attribute is in self.params
-        for i, n in enumerate(self.function.__code__.co_varnames[1:]):
-            if n == name:
-                return self.params[i]
-        error = "'{}' event has no '{}' attribute".format(self.type(), name)
-        raise AttributeError(error)
-
-    def __setattr__(self, name, value):
-        # Checks if attribute is in self.params
-        for i, n in enumerate(self.function.__code__.co_varnames[1:]):
-            if n == name:
-                self.params[i] = value
-                return
-
-        object.__setattr__(self, name, value)
+                                          self.name,
+                                          self.params())
 
     def __lt__(self, other):
-        return self.timestamp < other.timestamp
+        return self.tick < other.tick
 
     def __gt__(self, other):
-        return self.timestamp > other.timestamp
+        return self.tick > other.tick
 
     def __le__(self, other):
-        return self.timestamp <= other.timestamp
+        return self.tick <= other.tick
 
     def __ge__(self, other):
-        return self.timestamp >= other.timestamp
+        return self.tick >= other.tick
 
     def __ne__(self, other):
-        return self.timestamp != other.timestamp
+        return self.tick != other.tick
+
+
+class NoteOff(Event):
+    __slots__ = ('note',)
+    kind = NOTE_OFF
+    name = 'note_off'
+    fields = ('note',)
+
+    def __init__(self, timestamp, note):
+        Event.__init__(self, timestamp)
+        self.note = note
 
+    def call(self, part):
+        midi.write([midi.NOTE_ON + part.channel, self.note, 0],
+                   sequencer.event_timestamp(), part.name, part.port)
+
+
+class NoteOn(Event):
+    __slots__ = ('note', 'velocity', 'length')
+    kind = NOTE_ON
+    name = 'note_on'
+    fields = ('note', 'velocity', 'length')
 
-def note_off(part, note):
-    midi.out.write_short(midi.NOTE_ON + part.channel, note, 0)
+    def __init__(self, timestamp, note, velocity, length):
+        Event.__init__(self, timestamp)
+        self.note = note
+        self.velocity = velocity
+        self.length = length
+
+    def call(self, part):
+        midi.write([midi.NOTE_ON + part.channel, self.note, self.velocity],
+                   sequencer.event_timestamp(), part.name, part.port)
+        # Replaces any future note off event with the same pitch
+        off_tick = sequencer.event_position() + sequencer.to_ticks(self.length)
+        part.future_events.push_note_off(part.channel, self.note,
+                                         NoteOff.at_tick(off_tick, self.note))
 
 
-def note_on(part, note, velocity, length):
-    midi.out.write_short(midi.NOTE_ON + part.channel, note, velocity)
-    # Remove future note off events with same pitch
-    part.future_events = [e for e in part.future_events
-                          if not (e.type() == 'note_off' and
-                                  e.note == note)]
-    part.append_future(Event(sequencer.running_time + length,
-                             note_off, [note]))
+class ControlChange(Event):
+    __slots__ = ('cc', 'data')
+    kind = CC
+    name = 'cc'
+    fields = ('cc', 'data')
 
+    def __init__(self, timestamp, cc, data):
+        Event.__init__(self, timestamp)
+        self.cc = cc
+        self.data = data
 
-def cc(part, cc, data):
-    midi.out.write_short(midi.CC + part.channel, cc, data)
+    def call(self, part):
+        midi.write([midi.CC + part.channel, self.cc, self.data],
+                   sequencer.event_timestamp(), part.name, part.port)
+
+EVENT_CLASSES = {cls.name: cls for cls in (NoteOn, NoteOff, ControlChange)}
+
+
+# YAML Event representation
+def event_representer(dumper, data):
+    mapping = {field: getattr(data, field) for field in data.fields}
+    mapping['timestamp'] = data.timestamp
+    return dumper.represent_mapping(u'!' + data.name, mapping)
+
+
+def event_constructor(loader, node):
+    m = loader.construct_mapping(node)
+    cls = EVENT_CLASSES[node.tag[1:]]
+    return cls(m['timestamp'], *[m[field] for field in cls.fields])
+
+
+def legacy_event_constructor(loader, node):
+    """Construct events saved as python objects by older versions.
+
+    They were stored as a timestamp, a reference to an event function named
+    like the event, and a list of its parameters.
+    """
+    timestamp = 0
+    name = None
+    params = []
+    for key_node, value_node in node.value:
+        key = loader.construct_scalar(key_node)
+        if key == 'timestamp':
+            timestamp = loader.construct_object(value_node)
+        elif key == 'function':
+            # Tagged like tag:yaml.org,2002:python/name:event.note_on
+            name = value_node.tag.split('.')[-1]
+        elif key == 'params':
+            params = loader.construct_sequence(value_node, deep=True)
+    return EVENT_CLASSES[name](timestamp, *params)
+
+for cls in EVENT_CLASSES.values():
+    yaml.add_representer(cls, event_representer)
+    yaml.add_constructor(u'!' + cls.name, event_constructor)
+yaml.add_constructor(u'tag:yaml.org,2002:python/object:event.Event',
+                     legacy_event_constructor)
@@ -1,6 +1,8 @@
 import pygame
 import yaml
 
+from collections import OrderedDict
+
 SCREEN_SIZE = SCREEN_WIDTH, SCREEN_HEIGHT = 480, 272
 
 # Color theme
@@ -26,6 +28,40 @@ FONT_BIG = pygame.font.Font("fonts/ProggyClean.ttf", 16)
 FONT_MEDIUM = pygame.font.Font("fonts/ProggySmall.ttf", 16)
 FONT_SMALL = pygame.font.Font("fonts/ProggyTiny.ttf", 16)
 
+# Rendered texts are cached, since mostly the same ones are drawn every frame.
+# The least recently used are dropped when the cache is full.
+TEXT_CACHE_SIZE = 512
+text_cache = OrderedDict()  # (font, text, color, antialias, background)
+text_cache_hits = 0
+text_cache_misses = 0
+
+
+def render_text(font, text, color, antialias=False, background=None):
+    """Like font.render, but cached. The surface returned must not be drawn
+    on."""
+    global text_cache_hits, text_cache_misses
+    if background is not None:
+        background = tuple(background)
+    key = (font, text, tuple(color), antialias, background)
+    try:
+        surface = text_cache.pop(key)
+        text_cache_hits += 1
+    except KeyError:
+        text_cache_misses += 1
+        if background is None:
+            surface = font.render(text, antialias, color)
+        else:
+            surface = font.render(text, antialias, color, background)
+        if len(text_cache) >= TEXT_CACHE_SIZE:
+            text_cache.popitem(last=False)
+    text_cache[key] = surface
+    return surface
+
+
+def text_cache_stats():
+    """Return (hits, misses, cached texts) of the text cache."""
+    return text_cache_hits, text_cache_misses, len(text_cache)
+
 class ActionButton:
     """A regular rectangular button."""
 
@@ -52,7 +88,7 @@ class ActionButton:
 
     def render(self, surface):
         pygame.draw.rect(surface, C_PRIMARY, self.rect)
-        text = self.font.render(self.text, False, C_LIGHTEST)
+        text = render_text(self.font, self.text, C_LIGHTEST)
         xoffset = 2
         yoffset = 0
         if self.center_x:
@@ -93,7 +129,8 @@ class TextField:
         if self.focused:
             color = C_DARKER
         pygame.draw.rect(surface, color, self.rect)
-        text = self.font.render(self.text, False, C_LIGHTEST, color)
+        text = render_text(self.font, self.text, C_LIGHTEST,
+                           background=color)
 
         xoffset = 2
         yoffset = 0
@@ -116,7 +153,7 @@ class Counter:
         self.minimum = minimum
         self.maximum = maximum
         self.height = height
-        self.text = self.font.render(text, False, C_DARKER)
+        self.text = render_text(self.font, text, C_DARKER)
         OFFSET = 5
         self.dec = ActionButton((self.text.get_width() + x + OFFSET, y),
                                 (height, height), '-',
@@ -155,7 +192,7 @@ class Counter:
         self.dec.render(surface)
         self.inc.render(surface)
 
-        number = self.font.render((str(self.value)), False, C_DARKER)
+        number = render_text(self.font, (str(self.value)), C_DARKER)
         yoffset = self.dec.rect.height / 2 - self.text.get_rect().height / 2
         x = self.dec.rect.right + self.height / 2 - number.get_rect().width / 2
         y = self.pos[1] + yoffset
@@ -219,7 +256,7 @@ class ScrollList(object):
                 font_color = C_LIGHTEST
                 button_color = C_DARKER
             pygame.draw.rect(self.surface, button_color, rect)
-            text = self.font.render(string, False, font_color)
+            text = render_text(self.font, string, font_color)
             self.surface.blit(text, (rect.x, rect.y))
         surface.blit(self.surface, self.pos)
 
@@ -266,7 +303,7 @@ class RadioButtons:
                 button_color = C_DARKER
             pygame.draw.rect(surface, button_color, rect)
             try:
-                text = self.font.render(self.strings[i], False, font_color)
+                text = render_text(self.font, self.strings[i], font_color)
                 surface.blit(text, (rect.x, rect.y))
             except:
                 pass
@@ -5,6 +5,7 @@ import settings
 import gui
 import screen
 import sceneview
+import timing
 
 from config import ConfigScreen
 
@@ -16,23 +17,42 @@ settings.load_instruments()
 screen.stack.append(sceneview.SceneView())
 display = pygame.display.set_mode(gui.SCREEN_SIZE)
 if midi.init():
-    sequencer.start()
+    sequencer.lookahead = midi.config.get('lookahead', sequencer.lookahead)
+    clock_mode = midi.config.get('midi_clock', 'send')
+    sequencer.midiclock = sequencer.MC_NAMES[clock_mode]
+    if sequencer.midiclock != sequencer.MC_RECIEVE:
+        sequencer.start()
 else:
     screen.stack.append(ConfigScreen())
+if midi.config.get('engine_thread', False):
+    sequencer.start_engine()
+timing_log = midi.config.get('timing_log')
+timing.enabled = bool(timing_log)
 while 1:
     events = pygame.event.get()
-    midi.update_input_events()
-    screen.stack.top().update(events)
     for e in events:
         if e.type == pygame.QUIT:
+            sequencer.stop_engine()
             if sequencer.running:
                 sequencer.stop()
             midi.close()
+            if timing_log:
+                timing.dump(timing_log)
             sys.exit()
+    with sequencer.lock:
+        midi.update_devices()
+        midi.update_input_events()
+        if not sequencer.threaded():
+            sequencer.update()
+        sequencer.snapshot()
+        screen.stack.top().update(events)
+        midi.flush()
+    screen.run_deferred()
     pygame.event.pump()
-    sequencer.update()
 
-    surface = screen.stack.top().render()
-    if surface is not None:
-        display.blit(surface, (0, 0))
-        pygame.display.flip()
+    top = screen.stack.top()
+    rects = top.render()
+    if rects:
+        for rect in rects:
+            display.blit(top.surface, rect, rect)
+        pygame.display.update(rects)
@@ -1,7 +1,12 @@
-import pygame.midi as pm
+import timing
+import midibackend
+
 import yaml
 
-from collections import namedtuple
+from collections import namedtuple, deque
+import itertools
+import threading
+import time as _time
 
 NOTE_OFF = 0x80
 NOTE_ON = 0x90
@@ -12,6 +17,7 @@ AFTERTOUCH = 0xD0
 PITCH_WHEEL = 0xE0
 
 # MIDI clock
+MC_SONG_POSITION = 0xF2
 MC_CLOCK = 0xF8
 MC_START = 0xFA
 MC_CONTINUE = 0xFB
@@ -30,26 +36,182 @@ F = 96
 FF = 112
 FFF = 127
 
-out = 0
+# The backend opens the ports. It's set to the one in config.yml by init.
+backend = midibackend.NullBackend()
+out = 0  # the output of port 0
 m_in = 0
 in_channel = 0
+# Output latency in ms. Must be above 0 for PortMidi to respect timestamps.
+latency = 1
+config = {}  # the contents of config.yml
+
+# Messages written since the last flush, as (msg, timestamp, source, port,
+# scheduled). Messages to send as soon as possible aren't scheduled, and are
+# timestamped when written.
+pending_output = []
+MAX_WRITE = 1024  # the most messages pygame.midi can write at once
+# If set, called with (msg, timestamp, source, port) of every message sent
+capture = None
+
+# The output filter drops messages that wouldn't change anything: a CC with
+# the value it already has, a note off for a note that isn't sounding, and
+# channel mode messages (CC 120 and above) if nothing has been played on the
+# channel since the last one.
+filter_output = True
+BANK_SELECT = (0, 32)  # always sent, some devices need it before a PC
+MODE_CC = 120
+RESET_ALL_CONTROLLERS = 121
+PANIC_CCS = (123, 120, 121)  # all notes off, all sound off, reset controllers
+
+# The output state follows the messages in the order their timestamps come
+# up, not the order they are written in. Written messages with timestamps
+# still ahead are kept in scheduled_output, as (timestamp, order, port, msg),
+# and the filter decides on a message by the state at its timestamp.
+scheduled_output = []
+output_order = itertools.count()
+
+# channel is None for system messages, like the clock
+MidiEvent = namedtuple('MidiEvent', 'channel status data1 data2 timestamp')
+
+# MIDI in is read by a background thread into a ring buffer of
+# (timestamp, status, data1, data2). Each consumer reads it in order through
+# its own InputCursor. A consumer that falls behind by more than INPUT_SIZE
+# messages loses the oldest ones.
+INPUT_SIZE = 4096
+INPUT_INTERVAL = 0.001  # seconds between polls of m_in
+input_ring = deque(maxlen=INPUT_SIZE)
+input_count = 0  # messages ever put in input_ring
+input_lock = threading.Lock()
+input_thread = None
+input_running = False
+
+# The MIDI devices are enumerated once, and again only when the ALSA
+# sequencer clients change (checked in the background every
+# DEVICE_INTERVAL seconds). Then PortMidi is reinitialized, and the
+# configured ports are reopened by name.
+devices = []  # midibackend.DeviceInfo
+DEVICE_INTERVAL = 2.0
+DEVICE_SIGNATURE_FILE = '/proc/asound/seq/clients'
+devices_changed = False
+device_thread = None
+device_running = False
+# The ports we open show up in the ALSA sequencer clients too. The signature
+# they are compared to is taken again whenever we open or close ports, under
+# device_lock, so that only other clients count as changes.
+device_signature = None
+device_lock = threading.RLock()
+in_name = None  # the name of the open in device
+wanted_in = None  # the configured in device, opened when available
 
-MidiEvent = namedtuple('MidiEvent', 'channel status data1 data2 data3')
-input_events = set([])
+
+def scan_devices():
+    """Enumerate the MIDI devices."""
+    global devices
+    devices = backend.devices()
 
 
 def outDevices():
     """Return a list of tuples: (device name, output device number)"""
-    return [(pm.get_device_info(device_id)[1], device_id)
-            for device_id in range(pm.get_count())
-            if pm.get_device_info(device_id)[3] == 1]
+    return [(d.name, d.id) for d in devices if d.output]
 
 
 def inDevices():
     """Return a list of tuples: (device name, input device number)"""
-    return [(pm.get_device_info(device_id)[1], device_id)
-            for device_id in range(pm.get_count())
-            if pm.get_device_info(device_id)[2] == 1]
+    return [(d.name, d.id) for d in devices if d.input]
+
+
+def _device_signature():
+    """Something that changes when MIDI devices come and go.
+
+    None if there's no way to tell, which disables hot-plug detection.
+    """
+    try:
+        with open(DEVICE_SIGNATURE_FILE) as f:
+            return [line for line in f
+                    if line.startswith('Client') or
+                    line.startswith('  Port')]
+    except (IOError, OSError):
+        return None
+
+
+def _take_device_signature():
+    """Take the signature after opening or closing ports of our own."""
+    global device_signature
+    with device_lock:
+        device_signature = _device_signature()
+
+
+def _device_loop():
+    global devices_changed, device_signature
+    while device_running:
+        _time.sleep(DEVICE_INTERVAL)
+        with device_lock:
+            new_signature = _device_signature()
+            if new_signature != device_signature:
+                device_signature = new_signature
+                devices_changed = True
+
+
+def start_device_watch():
+    """Start watching for added or removed devices, in the background.
+
+    Run once the ports are open.
+    """
+    global device_thread, device_running
+    if device_thread is not None or _device_signature() is None:
+        return
+    _take_device_signature()
+    device_running = True
+    device_thread = threading.Thread(target=_device_loop, name='midi-devices')
+    device_thread.daemon = True
+    device_thread.start()
+
+
+def stop_device_watch():
+    global device_thread, device_running
+    if device_thread is None:
+        return
+    device_running = False
+    device_thread = None
+
+
+def use_backend(new_backend):
+    """Close the ports, and (re)initialize MIDI with new_backend."""
+    global backend, out, m_in, in_name
+    flush()
+    with device_lock:
+        for port in ports:
+            port.close()
+        out = 0
+        with input_lock:
+            if m_in:
+                m_in.close()
+                m_in = 0
+                in_name = None
+            backend.quit()
+            backend = new_backend
+            backend.init()
+            scan_devices()
+        _take_device_signature()
+
+
+def update_devices():
+    """Reopen the configured devices if the devices have changed.
+
+    Run every frame, while holding the sequencer lock.
+    """
+    global devices_changed
+    if not devices_changed:
+        return
+    with device_lock:
+        devices_changed = False
+        # The PortMidi time keeps running through this
+        use_backend(backend)
+        for i, port in enumerate(ports):
+            if port.wanted is not None:
+                set_out_device(port.wanted, i)
+        if wanted_in is not None:
+            set_in_device(wanted_in)
 
 
 def sweep_cc(control, start, end, time, offset=0):
@@ -70,75 +232,520 @@ def note_to_string(note):
     return note + str(octave)
 
 
-def set_out_device(name):
+class OutPort(object):
+    """A MIDI out port.
+
+    If writing to the backend may block, the port is written to by its own
+    thread, so that a slow device doesn't hold up the others.
+    """
+
+    def __init__(self):
+        self.wanted = None  # the configured device, opened when available
+        self.name = None  # the name of the open device
+        self.output = 0
+        self.batches = deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def open(self, name):
+        """Open the device called name. Return False if it isn't there."""
+        self.close()
+        self.wanted = name
+        for od in outDevices():
+            if od[0] == name:
+                self.output = backend.open_output(od[1], latency)
+                self.name = name
+                if backend.threaded_output:
+                    self.running = True
+                    self.thread = threading.Thread(target=self._writer,
+                                                   name='midi-out')
+                    self.thread.daemon = True
+                    self.thread.start()
+                return True
+        return False
+
+    def close(self):
+        """Send what is left to send, and close the device."""
+        if self.thread is not None:
+            with self.condition:
+                self.running = False
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+        if self.output:
+            self.output.close()
+        self.output = 0
+        self.name = None
+
+    def write(self, data, timed=()):
+        """Write a list of [msg, timestamp].
+
+        timed is a list of (source, timestamp) of the scheduled messages in
+        data, recorded in the timing stats once they have been written.
+        """
+        if self.thread is None:
+            self._write(data, timed)
+        else:
+            with self.condition:
+                self.batches.append((data, timed))
+                self.condition.notify()
+
+    def _write(self, data, timed):
+        for i in range(0, len(data), MAX_WRITE):
+            self.output.write(data[i:i + MAX_WRITE])
+        if timed and timing.enabled:
+            now = time()
+            for source, timestamp in timed:
+                timing.record(source, timestamp, now)
+
+    def _writer(self):
+        while True:
+            with self.condition:
+                while self.running and not self.batches:
+                    self.condition.wait()
+                if not self.batches:
+                    return
+                data, timed = self.batches.popleft()
+            self._write(data, timed)
+
+# Port 0 is midi_out in config.yml, the rest are midi_outs
+ports = [OutPort()]
+ALL_PORTS = -1  # for messages sent to every port, like the clock
+
+
+def set_out_device(name, port=0):
+    """Open the device called name on port. Return False if it isn't there."""
     global out
-    if out:
-        out.close()
-    for od in outDevices():
-        if od[0] == name:
-            out = pm.Output(od[1], 1)
+    flush()
+    while len(ports) <= port:
+        ports.append(OutPort())
+    # Reopening the same device, like after the devices have changed, keeps
+    # the output state, so the note offs of what is sounding on it aren't
+    # filtered out. Another device starts over, once the old one has been
+    # silenced.
+    if name != ports[port].wanted:
+        if ports[port].output:
+            ports[port].write(_silence_port(port, time()))
+        reset_filter(port)
+    with device_lock:
+        opened = ports[port].open(name)
+        _take_device_signature()
+    if port == 0:
+        out = ports[0].output
+    return opened
+
+
+def time():
+    """The backend time in ms, used for timestamps."""
+    return backend.time()
+
+
+def write(msg, timestamp=None, source=None, port=0):
+    """Queue a short MIDI message for port, to be sent on the next flush.
+
+    msg is a list of a status byte and up to two data bytes. If timestamp
+    (PortMidi time) is given the message is sent at timestamp + latency,
+    otherwise as soon as possible. source names what sent the message, for
+    the timing stats.
+    """
+    if timestamp is None:
+        pending_output.append((msg, time(), source, port, False))
+    else:
+        pending_output.append((msg, timestamp, source, port, True))
+
+
+def flush():
+    """Write all queued messages, in one go for each port.
+
+    Run at the end of each engine step and UI frame. Messages for ports that
+    aren't open are dropped.
+    """
+    if not pending_output:
+        return
+    messages = list(pending_output)
+    del pending_output[:]
+    # Some PortMidi backends need the timestamps in order
+    messages.sort(key=lambda message: message[1])
+    now = time()
+    _apply_due(now)
+    # Messages already written for later, or written now for later, must be
+    # taken into the state in timestamp order. The filter then works on a
+    # copy of the state, which is brought up to each message's timestamp.
+    state = output_state
+    if scheduled_output or messages[-1][1] > now:
+        state = state.copy()
+    later = 0  # scheduled_output[:later] have been taken into state
+    written = []
+    batches = {}
+    timed = {}  # port: (source, timestamp) of the scheduled messages
+    for msg, timestamp, source, port, scheduled in messages:
+        while (later < len(scheduled_output) and
+               scheduled_output[later][0] <= timestamp):
+            state.update(*scheduled_output[later][2:])
+            later += 1
+        if port == ALL_PORTS:
+            targets = range(len(ports))
+        else:
+            targets = (port,)
+        for target in targets:
+            if target >= len(ports) or not ports[target].output:
+                continue
+            if not state.update(target, msg) and filter_output:
+                continue
+            batches.setdefault(target, []).append([msg, timestamp])
+            if state is not output_state:
+                written.append((timestamp, next(output_order), target, msg))
+            if capture is not None:
+                capture(msg, timestamp, source, target)
+            if scheduled:
+                timed.setdefault(target, []).append((source, timestamp))
+    if written:
+        scheduled_output.extend(written)
+        scheduled_output.sort()
+        _apply_due(now)
+    for port, data in batches.items():
+        ports[port].write(data, timed.get(port, ()))
+
+
+class OutputState(object):
+    """What the output ports have been sent.
+
+    The notes sounding on each port and channel are kept as bitmaps, so
+    stopping a part only needs note offs for what it is actually playing.
+    """
+
+    def __init__(self):
+        self.notes = {}  # (port, channel): bitmap of the sounding notes
+        self.sent_cc = {}  # (port, channel, cc): value
+        # (port, channel) played since the last mode message
+        self.played_channels = set()
+
+    def copy(self):
+        state = OutputState()
+        state.notes = dict(self.notes)
+        state.sent_cc = dict(self.sent_cc)
+        state.played_channels = set(self.played_channels)
+        return state
+
+    def update(self, port, msg):
+        """Update the state of port with msg. False if msg can be dropped."""
+        status = msg[0] & 0xf0
+        if status != CC and status != NOTE_ON and status != NOTE_OFF:
             return True
-    return False
+        channel = (port, msg[0] & 0x0f)
+        if status == NOTE_ON and msg[2] > 0:
+            self.notes[channel] = self.notes.get(channel, 0) | 1 << msg[1]
+            self.played_channels.add(channel)
+            return True
+        if status != CC:
+            bit = 1 << msg[1]
+            if not self.notes.get(channel, 0) & bit:
+                return False
+            self.notes[channel] &= ~bit
+            return True
+        cc, value = msg[1], msg[2]
+        if cc >= MODE_CC:
+            if channel not in self.played_channels:
+                return False
+            self.played_channels.discard(channel)
+            self.notes.pop(channel, None)
+            if cc == RESET_ALL_CONTROLLERS:
+                for key in [key for key in self.sent_cc
+                            if key[:2] == channel]:
+                    del self.sent_cc[key]
+            return True
+        if cc in BANK_SELECT:
+            return True
+        key = channel + (cc,)
+        if self.sent_cc.get(key) == value:
+            return False
+        self.sent_cc[key] = value
+        return True
+
+    def sounding_notes(self, port, channel):
+        bitmap = self.notes.get((port, channel), 0)
+        return [note for note in range(128) if bitmap & 1 << note]
+
+    def reset(self, port):
+        for key in [key for key in self.sent_cc if key[0] == port]:
+            del self.sent_cc[key]
+        for key in [key for key in self.notes if key[0] == port]:
+            del self.notes[key]
+        self.played_channels.difference_update(
+            [key for key in self.played_channels if key[0] == port])
+
+output_state = OutputState()  # as of the messages that are due
+
+
+def _apply_due(now):
+    """Move the written messages that are due into output_state."""
+    due = 0
+    for timestamp, order, port, msg in scheduled_output:
+        if timestamp > now:
+            break
+        output_state.update(port, msg)
+        due += 1
+    del scheduled_output[:due]
+
+
+def sounding_notes(port, channel):
+    """The notes sounding on channel of port now, as far as has been sent."""
+    return output_state.sounding_notes(port, channel)
+
+
+def reset_filter(port):
+    """Forget the output state of port, for when its device changes."""
+    output_state.reset(port)
+    scheduled_output[:] = [entry for entry in scheduled_output
+                           if entry[2] != port]
+
+
+def _silence(state, port, timestamp):
+    """Note offs for the notes sounding in state, and the panic CCs, on every
+    channel of port."""
+    data = []
+    for channel in range(16):
+        for note in state.sounding_notes(port, channel):
+            data.append([[NOTE_OFF + channel, note, 0], timestamp])
+        for cc in PANIC_CCS:
+            data.append([[CC + channel, cc, 0], timestamp])
+    return data
+
+
+def _silence_port(port, now):
+    """What silences port at now, and again after the last of the messages
+    already written for later to it, since those notes will still start."""
+    final = output_state.copy()
+    end = now
+    for entry in scheduled_output:
+        if entry[2] == port:
+            final.update(*entry[2:])
+            end = entry[0]
+    data = _silence(output_state, port, now)
+    if end > now:
+        data.extend(_silence(final, port, end))
+    return data
+
+
+def panic():
+    """Silence every port right away.
+
+    Sends a note off for every sounding note, then all notes off, all sound
+    off and reset all controllers on every channel, whether or not anything
+    was played there. Notes already written for later will still start, so
+    the same is sent again after the last of them. The caller should make
+    sure no note offs are sent later for notes started before the panic.
+    """
+    flush()
+    now = time()
+    for port, out_port in enumerate(ports):
+        if not out_port.output:
+            continue
+        out_port.write(_silence_port(port, now))
+        reset_filter(port)
 
 
 def set_in_device(name):
-    global m_in
-    if m_in:
-        m_in.close()
-    for in_d in inDevices():
-        if in_d[0] == name:
-            m_in = pm.Input(in_d[1])
-            return True
-    return False
+    global m_in, in_name, wanted_in
+    wanted_in = name
+    opened = False
+    with device_lock:
+        with input_lock:
+            if m_in:
+                m_in.close()
+                m_in = 0
+                in_name = None
+            for in_d in inDevices():
+                if in_d[0] == name:
+                    m_in = backend.open_input(in_d[1])
+                    in_name = name
+                    opened = True
+                    break
+        _take_device_signature()
+    return opened
+
+
+def poll_input():
+    """Move everything available from m_in to input_ring."""
+    global input_count
+    with input_lock:
+        while m_in and m_in.poll():
+            for data, timestamp in m_in.read(1000):
+                input_ring.append((timestamp, data[0], data[1], data[2]))
+                input_count += 1
+
+
+def _input_loop():
+    while input_running:
+        poll_input()
+        _time.sleep(INPUT_INTERVAL)
+
+
+def start_input():
+    """Start reading MIDI in, in the background."""
+    global input_thread, input_running
+    if input_thread is not None:
+        return
+    input_running = True
+    input_thread = threading.Thread(target=_input_loop, name='midi-in')
+    input_thread.daemon = True
+    input_thread.start()
+
+
+def stop_input():
+    global input_thread, input_running
+    if input_thread is None:
+        return
+    input_running = False
+    input_thread.join()
+    input_thread = None
+
+
+class InputCursor(object):
+    """A position in the received MIDI in messages."""
+
+    def __init__(self):
+        with input_lock:
+            self.position = input_count
+
+    def read(self):
+        """Return the messages received since the last read, in order."""
+        with input_lock:
+            oldest = input_count - len(input_ring)
+            start = max(self.position, oldest)
+            messages = [input_ring[i - oldest]
+                        for i in range(start, input_count)]
+            self.position = input_count
+        return messages
+
+    def skip(self):
+        """Skip the messages received since the last read."""
+        with input_lock:
+            self.position = input_count
+
+
+class InputRouter(object):
+    """Sorts the messages of an InputCursor by (channel, status).
+
+    Each route() classifies the new messages once. They can then be looked
+    up by (channel, status) with events(), and are also appended to the
+    queues of the subscribers of their (channel, status). Note on with
+    velocity 0 is routed as note off.
+    """
+
+    def __init__(self):
+        self.cursor = InputCursor()
+        self.routed = {}  # (channel, status): the messages of the last route
+        self.subscribers = {}  # (channel, status): list of queues
+
+    def subscribe(self, *keys):
+        """Return a queue that gets the messages of all keys, in order.
+
+        keys are (channel, status) tuples.
+        """
+        queue = deque()
+        for key in keys:
+            self.subscribers.setdefault(key, []).append(queue)
+        return queue
+
+    def route(self):
+        routed = {}
+        for timestamp, status, data1, data2 in self.cursor.read():
+            if status >= 0xF0:
+                channel = None
+            else:
+                channel = status & 0x0f
+                status = status & 0xf0
+                if status == NOTE_ON and data2 == 0:
+                    status = NOTE_OFF
+            key = (channel, status)
+            event = MidiEvent(channel, status, data1, data2, timestamp)
+            if key in routed:
+                routed[key].append(event)
+            else:
+                routed[key] = [event]
+            for queue in self.subscribers.get(key, ()):
+                queue.append(event)
+        self.routed = routed
+
+    def events(self, channel, status):
+        """The messages of (channel, status) in the last route."""
+        return self.routed.get((channel, status), [])
+
+
+# Routes the input of the UI, once per frame
+router = InputRouter()
+# Routes the input of the sequencer engine
+engine_router = InputRouter()
+clock_queue = engine_router.subscribe((None, MC_CLOCK),
+                                      (None, MC_START),
+                                      (None, MC_CONTINUE),
+                                      (None, MC_STOP),
+                                      (None, MC_SONG_POSITION))
+
+
+def read_clock():
+    """Pop and yield the received clock and song position messages."""
+    engine_router.route()
+    while clock_queue:
+        yield clock_queue.popleft()
+
+
+def skip_clock():
+    """Drop the clock and song position messages received so far.
+
+    Run while the clock isn't received, so that nothing buffered meanwhile
+    is acted on when it is.
+    """
+    engine_router.cursor.skip()
+    clock_queue.clear()
 
 
 def update_input_events():
     """Should be run once per frame in order to keep midi in data fresh."""
-    global input_events
-    if m_in and m_in.poll():
-        input_events = set([MidiEvent(e[0][0] & 0x0f,
-                                      e[0][0] & 0xf0,
-                                      e[0][1],
-                                      e[0][2],
-                                      e[0][3])
-                            for e in m_in.read(1000)])
-    else:
-        input_events = set([])
+    router.route()
 
 
 def note_on_events():
     """A list of all note on events this frame."""
-    return [e for e in input_events
-            if e.channel == in_channel and e.status == NOTE_ON]
+    return router.events(in_channel, NOTE_ON)
 
 
 def note_off_events():
     """A list of all note off events this frame.
     Note on with velocity 0 is treated as note off."""
-    return [e for e in input_events
-            if e.channel == in_channel and
-            (e.status == NOTE_OFF or
-             e.status == NOTE_ON and e.data2 == 0)]
+    return router.events(in_channel, NOTE_OFF)
 
 
 def init():
     """Initialize MIDI, return False if we haven't set up a MIDI Out Device."""
-    global m_in, in_channel
-    pm.init()
+    global m_in, in_channel, config, latency, filter_output
     config_yaml = yaml.load(file('config.yml', 'r'))
+    config = config_yaml
+    backend_name = config.get('midi_backend', midibackend.PortMidiBackend.name)
+    use_backend(midibackend.BACKENDS[backend_name]())
+    latency = max(1, config.get('latency', latency))
+    filter_output = config.get('output_filter', filter_output)
     try:
         in_channel = config_yaml['midi_in_channel']
         set_in_device(config_yaml['midi_in'])
     except:
         m_in = 0
-    if not set_out_device(config_yaml['midi_out']):
-        return False
-    return True
+    start_input()
+    for port, name in enumerate(config.get('midi_outs', []), 1):
+        set_out_device(name, port)
+    opened = set_out_device(config_yaml['midi_out'])
+    start_device_watch()
+    return opened
 
 
 def close():
-    if out:
-        out.close()
+    flush()
+    stop_input()
+    stop_device_watch()
+    for port in ports:
+        port.close()
     if m_in:
         m_in.close()
-    pm.quit()
+    backend.quit()
@@ -0,0 +1,162 @@
+"""MIDI backends, used by midi.py for everything that touches MIDI devices.
+
+A backend enumerates devices, opens ports and keeps the time. Output ports
+have write(data) and close(), where data is a list of [msg, timestamp]. Input
+ports have poll(), read(count) and close(), like pygame.midi.
+
+PortMidiBackend is the real thing. NullBackend and RecordingBackend work
+without any MIDI devices, for running the sequencer headless.
+"""
+
+from collections import namedtuple
+
+import time as _time
+
+# input and output are True if the device is an input or output
+DeviceInfo = namedtuple('DeviceInfo', 'name id input output')
+
+
+class Backend(object):
+    """Abstract base class of the backends."""
+    name = None
+    threaded_output = False  # True if writing to an output may block
+
+    def init(self):
+        pass
+
+    def quit(self):
+        pass
+
+    def time(self):
+        """The time in ms, used for timestamps."""
+        raise NotImplementedError
+
+    def devices(self):
+        """Return a list of DeviceInfo."""
+        return []
+
+    def open_output(self, device_id, latency):
+        raise NotImplementedError
+
+    def open_input(self, device_id):
+        raise NotImplementedError
+
+
+class PortMidiBackend(Backend):
+    """MIDI devices through pygame.midi."""
+    name = 'portmidi'
+    threaded_output = True
+
+    def __init__(self):
+        import pygame.midi
+        self.pm = pygame.midi
+
+    def init(self):
+        self.pm.init()
+
+    def quit(self):
+        self.pm.quit()
+
+    def time(self):
+        return self.pm.time()
+
+    def devices(self):
+        found = []
+        for device_id in range(self.pm.get_count()):
+            interface, name, is_input, is_output, opened = \
+                self.pm.get_device_info(device_id)
+            found.append(DeviceInfo(name, device_id,
+                                    is_input == 1, is_output == 1))
+        return found
+
+    def open_output(self, device_id, latency):
+        return self.pm.Output(device_id, latency)
+
+    def open_input(self, device_id):
+        return self.pm.Input(device_id)
+
+
+class NullOutput(object):
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullInput(object):
+    def poll(self):
+        return False
+
+    def read(self, count):
+        return []
+
+    def close(self):
+        pass
+
+
+class NullBackend(Backend):
+    """Has one output and one input, which do nothing.
+
+    The time is the system time, starting at 0.
+    """
+    name = 'null'
+    DEVICE = 'Null'
+
+    def __init__(self):
+        self.start = _time.time()
+
+    def time(self):
+        return int((_time.time() - self.start) * 1000)
+
+    def devices(self):
+        return [DeviceInfo(self.DEVICE, 0, False, True),
+                DeviceInfo(self.DEVICE, 1, True, False)]
+
+    def open_output(self, device_id, latency):
+        return NullOutput()
+
+    def open_input(self, device_id):
+        return NullInput()
+
+
+class RecordingOutput(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def write(self, data):
+        for msg, timestamp in data:
+            self.backend.recorded.append((timestamp, list(msg)))
+
+    def close(self):
+        pass
+
+
+class RecordingBackend(NullBackend):
+    """Records everything written to its output as (timestamp, msg).
+
+    The time is simulated: it only changes with set_time and advance, so the
+    sequencer can be run faster than real time.
+    """
+    name = 'recording'
+    DEVICE = 'Recording'
+
+    def __init__(self):
+        NullBackend.__init__(self)
+        self.now = 0
+        self.recorded = []
+
+    def time(self):
+        return self.now
+
+    def set_time(self, ms):
+        self.now = int(ms)
+
+    def advance(self, ms):
+        self.now += int(ms)
+
+    def open_output(self, device_id, latency):
+        return RecordingOutput(self)
+
+BACKENDS = {backend.name: backend
+            for backend in (PortMidiBackend, NullBackend, RecordingBackend)}
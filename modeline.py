@@ -34,6 +34,6 @@ class Modeline(object):
         OFFSET = 10
         for i, s in enumerate(self.strings):
             COLOR = gui.C_DARKEST if i % 2 == 0 else gui.C_DARKER
-            text = self.font.render(s, False, COLOR)
+            text = gui.render_text(self.font, s, COLOR)
             surface.blit(text, (x, top + 1))
             x += text.get_rect().width + OFFSET
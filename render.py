@@ -0,0 +1,224 @@
+"""Render a project to a Standard MIDI File, faster than real time.
+
+The sequencer is run headless, on the recording MIDI backend with a simulated
+clock, and everything sent to MIDI out is written to a type 1 MIDI file: a
+tempo track, and one track for each part.
+
+    python render.py projects/song.yaml song.mid 0:8 1:16 0:8
+
+plays scene 0 for 8 bars, then scene 1 for 16 bars and scene 0 for 8 bars.
+Without an arrangement each scene is played for 4 bars, in order. Like when
+playing live, a new scene starts when the first of its parts loops after the
+switch was asked for.
+"""
+
+import sequencer
+import event
+import midi
+import midibackend
+
+import argparse
+import struct
+import yaml
+
+# How far the engine is run ahead on each update, in ticks. Must be shorter
+# than the shortest part.
+WINDOW = sequencer.TICKS_PER_STEP // 2
+BAR_STEPS = 16
+
+
+class RenderClip(object):
+    """Stands in for the editor of a clip, which is a pygame screen."""
+
+    def __init__(self, part):
+        self.part = part
+
+
+class RenderLoader(yaml.Loader):
+    """Loads a project without creating any editors."""
+
+
+def clip_constructor(loader, tag_suffix, node):
+    m = loader.construct_mapping(node, deep=True)
+    return RenderClip(m['part'])
+
+RenderLoader.add_multi_constructor(u'!', clip_constructor)
+
+
+def load_project(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=RenderLoader)
+
+
+def default_arrangement(project, bars=4):
+    return [(scene, bars) for scene in range(len(project['scenes']))]
+
+
+def run(project, arrangement):
+    """Play the arrangement of project, a list of (scene, bars).
+
+    Return {part name: [(song tick, port, msg)]} of what was sent, and the
+    length of the song in ticks.
+    """
+    recorder = midibackend.RecordingBackend()
+    midi.use_backend(recorder)
+    # Messages for ports that aren't open aren't sent, so the recorder is
+    # opened on every port a part uses.
+    last_port = max([0] + [clip.part.port for scene in project['scenes']
+                           for clip in scene])
+    for port in range(last_port + 1):
+        midi.set_out_device(recorder.DEVICE, port)
+    tracks = {}
+
+    def capture(msg, timestamp, source, port):
+        if source is not None and source != 'clock':
+            song_tick = int(round(timestamp * sequencer.ticks_per_ms()))
+            tracks.setdefault(source, []).append((song_tick, port, msg))
+    midi.capture = capture
+
+    sequencer.midiclock = sequencer.MC_NONE
+    sequencer.lookahead = 0
+    sequencer.project = project
+    sequencer.current_scene = arrangement[0][0]
+    sequencer.goto_scene = None
+    sequencer.stop()
+    sequencer.start()
+
+    section_end = 0
+    for i, (scene, bars) in enumerate(arrangement):
+        section_end += bars * sequencer.to_ticks(BAR_STEPS)
+        if i + 1 == len(arrangement):
+            play_until(recorder, section_end)
+        else:
+            # Ask for the next scene just before the section ends, so that
+            # it starts with the first part that loops from there.
+            play_until(recorder, section_end - 1)
+            sequencer.goto_scene = arrangement[i + 1][0]
+    recorder.set_time(sequencer.ms_at(section_end))
+    sequencer.stop()
+    midi.flush()
+    midi.capture = None
+    for name, messages in tracks.items():
+        tracks[name] = trim(messages, section_end)
+    return tracks, section_end
+
+
+def trim(messages, end):
+    """Drop the messages from end on, except for the note offs of notes
+    started before end, which are moved to end."""
+    trimmed = []
+    sounding = set()  # (port, channel, note) started before end
+    for song_tick, port, msg in sorted(messages,
+                                       key=lambda message: message[0]):
+        status = msg[0] & 0xf0
+        note_off = (status == midi.NOTE_OFF or
+                    status == midi.NOTE_ON and msg[2] == 0)
+        key = (port, msg[0] & 0x0f, msg[1]) if len(msg) > 1 else None
+        if song_tick < end:
+            if status == midi.NOTE_ON and not note_off:
+                sounding.add(key)
+            elif note_off:
+                sounding.discard(key)
+            trimmed.append((song_tick, port, msg))
+        elif note_off and key in sounding:
+            sounding.discard(key)
+            trimmed.append((end, port, msg))
+    return trimmed
+
+
+def play_until(recorder, song_tick):
+    """Run the sequencer until everything up to song_tick is scheduled."""
+    while sequencer.schedule_tick < song_tick:
+        target = min(sequencer.schedule_tick + WINDOW, song_tick)
+        recorder.set_time(sequencer.ms_at(target))
+        sequencer.schedule_tick = target
+        sequencer.update()
+
+
+def variable_length(value):
+    """value as a MIDI file variable length quantity."""
+    data = [value & 0x7f]
+    value >>= 7
+    while value:
+        data.insert(0, value & 0x7f | 0x80)
+        value >>= 7
+    return bytearray(data)
+
+
+def meta_event(kind, data):
+    return bytearray([0xff, kind]) + variable_length(len(data)) + \
+        bytearray(data)
+
+
+def track_chunk(events, length):
+    """A track chunk of events, a list of (song tick, encoded event).
+
+    The track ends at length, or at the last event if that is later.
+    """
+    data = bytearray()
+    last_tick = 0
+    for song_tick, e in sorted(events, key=lambda e: e[0]):
+        data += variable_length(song_tick - last_tick) + e
+        last_tick = song_tick
+    data += variable_length(max(0, length - last_tick))
+    data += meta_event(0x2f, b'')
+    return bytearray(b'MTrk') + bytearray(struct.pack('>L', len(data))) + data
+
+
+def tempo_track(name, bpm, length):
+    tempo = int(round(60000000.0 / bpm))
+    return track_chunk([
+        (0, meta_event(0x03, name.encode('utf-8'))),
+        (0, meta_event(0x58, [4, 2, 24, 8])),
+        (0, meta_event(0x51, [tempo >> 16, tempo >> 8 & 0xff, tempo & 0xff]))
+    ], length)
+
+
+def part_track(name, messages, length):
+    """A track of messages, a list of (song tick, port, msg).
+
+    The port is given by MIDI port meta events, where it changes.
+    """
+    events = [(0, meta_event(0x03, name.encode('utf-8')))]
+    last_port = None
+    for song_tick, port, msg in messages:
+        if port != last_port:
+            events.append((song_tick, meta_event(0x21, [port])))
+            last_port = port
+        events.append((song_tick, bytearray(msg)))
+    return track_chunk(events, length)
+
+
+def write_midi_file(path, project, tracks, length):
+    chunks = [tempo_track(project['name'], project['bpm'], length)]
+    for name in sorted(tracks):
+        chunks.append(part_track(name, tracks[name], length))
+    header = struct.pack('>4sLHHH', b'MThd', 6, 1, len(chunks),
+                         sequencer.PPQ)
+    with open(path, 'wb') as f:
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def render(project_path, midi_path, arrangement=None):
+    """Render the project in project_path to the MIDI file midi_path."""
+    project = load_project(project_path)
+    if not arrangement:
+        arrangement = default_arrangement(project)
+    tracks, length = run(project, arrangement)
+    write_midi_file(midi_path, project, tracks, length)
+
+
+def parse_section(text):
+    scene, bars = text.split(':')
+    return (int(scene), int(bars))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a project to MIDI.')
+    parser.add_argument('project')
+    parser.add_argument('midi_file')
+    parser.add_argument('arrangement', nargs='*', type=parse_section,
+                        help='scene:bars')
+    args = parser.parse_args()
+    render(args.project, args.midi_file, args.arrangement)
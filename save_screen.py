@@ -19,7 +19,7 @@ class SaveScreen(screen.Screen):
         self.modeline[0] = 'Save project'
 
     def _update(self, events):
-        self.has_changed = True
+        self.has_changed = screen.has_input(events)
         self.name_field.update(events)
 
     def _render(self, surface):
@@ -32,4 +32,4 @@ class SaveScreen(screen.Screen):
         sequencer.project['name'] = name
         path = 'projects/{}.yaml'.format(name.lower().replace(' ', '_'))
         sequencer.project['path'] = path
-        sequencer.save(path)
+        screen.defer(sequencer.save, path)
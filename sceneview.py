@@ -12,7 +12,7 @@ import midi
 
 from modeline import Modeline
 from clipsettings import ClipSettings
-from choicelist import ChoiceList
+import choicelist
 from save_screen import SaveScreen
 from config import ConfigScreen
 
@@ -41,17 +41,28 @@ class SceneView(screen.Screen):
         self.update_partrects()
         self.modeline = Modeline(len(ModelineSections))
         # sequencer.goto_scene = sequencer.current_scene
+        self.update_scene_modeline()
+
+    def update_scene_modeline(self):
+        self.scene_shown = sequencer.current_scene
         scene = 'Scene {}/{}'.format(sequencer.current_scene + 1,
                                      len(sequencer.project['scenes']))
         self.modeline[ModelineSections.Scene] = scene
 
     def update_partrects(self):
         """Update rectangles showing part information."""
+        self.boxes = {}  # part: (box_state, surface)
+        self.playheads = {}  # part: x of the playhead drawn
+        self.dirty_parts = []  # (index, part, area of the screen)
+        # The parts the boxes are for. The engine may switch scene before
+        # they are rendered, so they're rendered from this, not from the
+        # scene that is current by then.
+        self.parts = sequencer.parts()
         self.partrects = []
-        for i, part in enumerate(sequencer.parts()):
+        for i, part in enumerate(self.parts):
             rect = pygame.Rect(box_pos(i), (PART_BOX_SIZE, PART_BOX_SIZE))
             self.partrects.append(rect)
-        i = len(sequencer.parts())
+        i = len(self.parts)
         rect = pygame.Rect(box_pos(i), (PART_BOX_SIZE, PART_BOX_SIZE))
         self.partrects.append(rect)
 
@@ -65,6 +76,18 @@ class SceneView(screen.Screen):
         if len(sequencer.scene()) == 0 or not sequencer.running:
             sequencer._switch_scene()
 
+    def choose_project(self):
+        """Show the projects to load."""
+        files = [[f[len("projects/"):], f]
+                 for f in glob('projects/*.yaml')]
+        screen.stack.append(choicelist.ChoiceList(files, 'Load project'))
+
+    def load_project(self, path):
+        sequencer.load(path)
+        self.update_partrects()
+        self.update_scene_modeline()
+        self.has_changed = True
+
     def save_as(self):
         """Show save screen prompt."""
         screen.stack.append(SaveScreen())
@@ -74,10 +97,13 @@ class SceneView(screen.Screen):
         mods = pygame.key.get_mods()
         for e in keyevents:
             if mods & pygame.KMOD_SHIFT:
-                pass
+                if e.key == pygame.K_SPACE:
+                    sequencer.toggle_pause()
             elif mods & pygame.KMOD_CTRL:
                 if e.key == pygame.K_s:
                     self.save_as()
+                elif e.key == pygame.K_p:
+                    sequencer.panic()
             elif mods & pygame.KMOD_ALT:
                 # Change scene
                 if e.key == pygame.K_0:
@@ -95,20 +121,19 @@ class SceneView(screen.Screen):
                     sequencer.toggle()
                 elif e.key == pygame.K_o:
                     # Load file
-                    files = [[f[len("projects/"):], f]
-                             for f in glob('projects/*.yaml')]
-                    screen.stack.append(ChoiceList(files, 'Load project'))
+                    screen.defer(self.choose_project)
                 elif e.key == pygame.K_s:
                     # Save
                     path = sequencer.project['path']
                     if path is None:
                         self.save_as()
                     else:
-                        sequencer.save(path)
+                        screen.defer(sequencer.save, path)
                 elif e.key == pygame.K_v:
                     # Paste
                     if self.clip_copy is not None:
                         sequencer.scene().append(self.clip_copy)
+                        sequencer.invalidate()
                         self.update_partrects()
                 elif e.key == pygame.K_p:
                     # Preferences
@@ -141,6 +166,7 @@ class SceneView(screen.Screen):
                         # Delete clip
                         clip.part.stop()
                         del scene[i]
+                        sequencer.invalidate()
                         self.update_partrects()
                     elif keys[pygame.K_c]:
                         # Copy clip
@@ -161,45 +187,99 @@ class SceneView(screen.Screen):
                     return
 
     def _update(self, events):
-        self.has_changed = True
+        self.has_changed = screen.has_input(events)
+        # The engine may have switched scene
+        if self.scene_shown != sequencer.current_scene:
+            self.update_partrects()
+            self.update_scene_modeline()
+            self.has_changed = True
         self.keydown_events((e for e in events
                              if e.type == pygame.KEYDOWN))
         self.mousedown_events((e for e in events
                                if e.type == pygame.MOUSEBUTTONDOWN))
+        if not self.has_changed:
+            self.find_dirty_parts()
+
+    def box_state(self, part):
+        """What the box of part shows, except for the playhead."""
+        return (part.name, part._variant, part.mute, part.toggle)
+
+    def playhead_x(self, part, rect):
+        timestamp = sequencer.playback.running_time % part.length
+        return int(timestamp / part.length * PART_BOX_SIZE + rect.x)
+
+    def mark_part_dirty(self, index, part, area):
+        self.dirty_parts.append((index, part, area))
+        self.mark_dirty(area)
+
+    def find_dirty_parts(self):
+        """Mark the boxes which have changed, and the playhead strips which
+        have moved."""
+        for i, part in enumerate(self.parts):
+            rect = self.partrects[i]
+            box = self.boxes.get(part)
+            if box is None or box[0] != self.box_state(part):
+                self.mark_part_dirty(i, part, pygame.Rect(
+                    rect.topleft, (PART_BOX_SIZE, PART_BOX_SIZE + 1)))
+            x = self.playhead_x(part, rect)
+            old_x = self.playheads.get(part)
+            if x != old_x:
+                for strip_x in (old_x, x):
+                    if strip_x is not None:
+                        self.mark_part_dirty(i, part, pygame.Rect(
+                            strip_x, rect.top, 1, PART_BOX_SIZE + 1))
+
+    def clip_box(self, part):
+        """The box of part without the playhead, cached until what it shows
+        changes."""
+        state = self.box_state(part)
+        box = self.boxes.get(part)
+        if box is not None and box[0] == state:
+            return box[1]
+        # One pixel higher, for the bottom end of the playhead line
+        surface = pygame.Surface((PART_BOX_SIZE, PART_BOX_SIZE + 1))
+        surface.fill(gui.C_LIGHTER)
+        rect = pygame.Rect(0, 0, PART_BOX_SIZE, PART_BOX_SIZE)
+        if part.toggle:
+            color = gui.C_DARKEST
+        else:
+            color = gui.C_DARKER
+        pygame.draw.rect(surface, color, rect, True)
+        pos = rect.move(2, 2).topleft
+        text = gui.render_text(self.font, part.name, color)
+        surface.blit(text, pos)
+        variant_text = gui.render_text(self.font,
+                                       'V:{}'.format(part._variant + 1),
+                                       color)
+        x, y = rect.bottomleft
+        surface.blit(variant_text, (x + 4, y - 12))
+        if part.mute:
+            pygame.draw.line(surface, color,
+                             rect.topleft, rect.bottomright)
+            pygame.draw.line(surface, color,
+                             rect.topright, rect.bottomleft)
+        self.boxes[part] = (state, surface)
+        return surface
+
+    def render_playhead(self, surface, part, rect):
+        x = self.playhead_x(part, rect)
+        pygame.draw.line(surface, gui.C_PRIMARY,
+                         (x, rect.top), (x, rect.bottom))
+        self.playheads[part] = x
 
     def focus(self, *args, **kwargs):
         self.clip_copy = None
         if 'load_project' in kwargs:
-            sequencer.load(kwargs['load_project'])
+            screen.defer(self.load_project, kwargs['load_project'])
         self.update_partrects()
 
     def _render(self, surface):
         # Render part boxes
-        for i, part in enumerate(sequencer.parts()):
+        self.dirty_parts = []
+        for i, part in enumerate(self.parts):
             rect = self.partrects[i]
-            if part.toggle:
-                color = gui.C_DARKEST
-            else:
-                color = gui.C_DARKER
-            pygame.draw.rect(surface, color, rect, True)
-            pos = rect.move(2, 2).topleft
-            text = self.font.render(part.name, False, color)
-            surface.blit(text, pos)
-            variant_text = self.font.render('V:{}'.format(part._variant + 1),
-                                            False, color)
-            x, y = rect.bottomleft
-            surface.blit(variant_text, (x + 4, y - 12))
-            # Playtime
-            timestamp = sequencer.running_time % part.length
-            played_x = timestamp / part.length * PART_BOX_SIZE + rect.x
-            pygame.draw.line(surface, gui.C_PRIMARY,
-                             (played_x, rect.top),
-                             (played_x, rect.bottom))
-            if part.mute:
-                pygame.draw.line(surface, color,
-                                 rect.topleft, rect.bottomright)
-                pygame.draw.line(surface, color,
-                                 rect.topright, rect.bottomleft)
+            surface.blit(self.clip_box(part), rect)
+            self.render_playhead(surface, part, rect)
         # Add box
         rect = self.partrects[-1]
         color = gui.C_DARKER
@@ -213,3 +293,12 @@ class SceneView(screen.Screen):
                          (centerx + OFFSET, centery), 2)
         self.modeline.render(surface)
         return surface
+
+    def _render_dirty(self, surface, rects):
+        """Repaint the changed boxes and playhead strips."""
+        for i, part, area in self.dirty_parts:
+            rect = self.partrects[i]
+            surface.blit(self.clip_box(part), area,
+                         area.move(-rect.x, -rect.y))
+            self.render_playhead(surface, part, rect)
+        self.dirty_parts = []
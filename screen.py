@@ -30,6 +30,33 @@ class ScreenStack:
 
 stack = ScreenStack()
 
+# Slow UI work, like file I/O, is deferred until the UI update has released
+# sequencer.lock, so that it doesn't hold up the engine thread.
+deferred = []
+
+
+def defer(func, *args):
+    """Run func(*args) after the UI update, outside sequencer.lock."""
+    deferred.append((func, args))
+
+
+def run_deferred():
+    while deferred:
+        func, args = deferred.pop(0)
+        func(*args)
+
+
+def has_input(events):
+    """True if events has key presses, clicks or drags, which may change what
+    a screen shows."""
+    for e in events:
+        if e.type in (pygame.KEYDOWN, pygame.KEYUP,
+                      pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+            return True
+        if e.type == pygame.MOUSEMOTION and any(e.buttons):
+            return True
+    return False
+
 
 class Screen(object):
     """Screen is meant to be used as an abstract base class for other "screens". A
@@ -41,7 +68,14 @@ class Screen(object):
     its behaviour (for instance a menu or settings screen); close() if something
     should happen before closing the screen.
 
+    Each screen draws on its own surface, which is kept between frames. Set
+    has_changed to redraw all of it, or pass the parts that have changed to
+    mark_dirty to only redraw those.
+
     """
+    surface = None
+    dirty_rects = ()
+
     def update(self, events):
         """Things that happen before the _update method."""
         self.has_changed = False
@@ -57,20 +91,45 @@ class Screen(object):
     def _update(self, events):
         pass
 
+    def mark_dirty(self, rect):
+        """Redraw rect on the next render."""
+        self.dirty_rects = list(self.dirty_rects) + [pygame.Rect(rect)]
+
     def render(self):
-        """Things that happen before the _render method."""
+        """Redraw what has changed on self.surface.
+
+        Return the list of rects that were redrawn, for
+        pygame.display.update().
+        """
+        if self.surface is None:
+            self.surface = pygame.Surface(gui.SCREEN_SIZE)
+            self.has_changed = True
         try:
-            if not self.has_changed:
-                return None
+            changed = self.has_changed
         except:
-            self.has_changed = True
-        surface = pygame.Surface(gui.SCREEN_SIZE)
-        surface.fill(gui.C_LIGHTER)
-        return self._render(surface)
+            changed = self.has_changed = True
+        rects = self.dirty_rects
+        self.dirty_rects = ()
+        if changed:
+            self.surface.fill(gui.C_LIGHTER)
+            self._render(self.surface)
+            return [self.surface.get_rect()]
+        if rects:
+            self._render_dirty(self.surface, rects)
+        return list(rects)
 
     def _render(self, surface):
         return surface
 
+    def _render_dirty(self, surface, rects):
+        """Redraw rects of surface. By default the whole screen is rendered,
+        clipped to each rect."""
+        for rect in rects:
+            surface.set_clip(rect)
+            surface.fill(gui.C_LIGHTER)
+            self._render(surface)
+        surface.set_clip(None)
+
     def close(self):
         """This method is run when you close the screen."""
         pass
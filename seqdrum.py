@@ -27,9 +27,10 @@ class SeqDrum(screen.Screen):
         self.part = part
         self.modeline = Modeline(len(ModelineSections))
         self.width = width
+        self.background = None  # the grid of the measure, without playhead
+        self.playhead = None  # the playing column, if in the measure
         self.measure = 0
         self.velocity_input = 104
-        self.last_curstep = -1
         if rows is None:
             self.rows = list()
         else:
@@ -50,6 +51,7 @@ class SeqDrum(screen.Screen):
         measure_string = "M:{}/{}".format(self.measure + 1,
                                           self.measures)
         self.modeline[ModelineSections.Measure] = measure_string
+        self.invalidate_grid()
 
     @property
     def velocity_input(self):
@@ -97,6 +99,25 @@ class SeqDrum(screen.Screen):
     def step_width(self):
         return gui.SCREEN_WIDTH // self.width
 
+    def invalidate_grid(self):
+        """Redraw the grid, after it or the measure shown has changed."""
+        self.background = None
+
+    def playhead_column(self):
+        """The playing column of the part, None if it isn't in the measure."""
+        if not self.rows:
+            return None
+        curstep = int(math.floor(sequencer.playback.running_time %
+                                 self.part.length))
+        if curstep // self.width != self.measure:
+            return None
+        return curstep
+
+    def column_rect(self, col):
+        height = len(self.rows) * self.STEP_HEIGHT
+        return pygame.Rect((col % self.width) * self.step_width(), 0,
+                           self.step_width(), height)
+
     def _populate_grid_with_event(self, note_on_event):
         for i, row in enumerate(self.rows):
             for char, note in row.iteritems():
@@ -111,9 +132,10 @@ class SeqDrum(screen.Screen):
     def part_to_grid(self):
         """Convert self.part data to self.grid"""
         self.grid = [[None] * self.part.length for r in self.rows]
-        events = self.part.events('note_on')
+        events = self.part.events(event.NOTE_ON)
         for e in events:
             self._populate_grid_with_event(e)
+        self.invalidate_grid()
 
     def note_char_pressed(self, row):
         """Return if a key is pressed which matches a note in the row."""
@@ -136,6 +158,7 @@ class SeqDrum(screen.Screen):
 
     def step_clicked(self, row, col):
         """Update status of a clicked step."""
+        self.invalidate_grid()
         if self.grid[row][col] is None:  # Empty step
             char = self.note_char_pressed(row)
             if not char:
@@ -145,12 +168,11 @@ class SeqDrum(screen.Screen):
                 char = 'normal'
 
             note = self.rows[row][char]
-            note_event = event.Event(col, event.note_on,
-                                     [note, self.velocity_input, 1])
+            note_event = event.NoteOn(col, note, self.velocity_input, 1)
             self.part.append(note_event)
         else:
             new_velocity = self.velocity_key()
-            for e in self.part.events('note_on'):
+            for e in self.part.step_events(col, event.NOTE_ON):
                 if(e.timestamp == col
                    and e.note in self.rows[row].values()):
                     if new_velocity:
@@ -161,10 +183,10 @@ class SeqDrum(screen.Screen):
                     return
 
     def _update(self, events):
-        curstep = math.floor(sequencer.running_time % self.part.length)
-        self.has_changed = curstep != self.last_curstep
-        self.last_curstep = curstep
-        self.velocity_input = self.velocity_key() or self.velocity_input
+        velocity = self.velocity_key() or self.velocity_input
+        if velocity != self.velocity_input:
+            self.velocity_input = velocity
+            self.has_changed = True
         for e in events:
             if e.type == pygame.MOUSEBUTTONDOWN and len(self.rows):
                 x, y = e.pos
@@ -178,30 +200,65 @@ class SeqDrum(screen.Screen):
                     if e.key == pygame.K_o:  # Options
                         screen.stack.append(RowEditor(self))
 
+        # Only the columns the playhead left and entered need redrawing,
+        # unless the grid has changed
+        if self.background is None and self.rows:
+            self.has_changed = True
+        playhead = self.playhead_column()
+        if playhead != self.playhead:
+            for col in (self.playhead, playhead):
+                if col is not None:
+                    self.mark_dirty(self.column_rect(col))
+            self.playhead = playhead
+
     def _render(self, surface):
         self.modeline.render(surface)
         if len(self.rows) == 0:
             string = 'Press Shift + O to add rows.'
-            text = self.font.render(string, False, gui.C_DARKEST)
+            text = gui.render_text(self.font, string, gui.C_DARKEST)
             surface.blit(text, (10, 10))
             return surface
-        curstep = math.floor(sequencer.running_time % self.part.length)
-        for row in range(len(self.grid)):
-            for col, data in enumerate(self.grid[row]):
-                pos = ((col % self.width) * self.step_width(),
-                       row * self.STEP_HEIGHT)
-                rect = pygame.Rect(pos, (self.step_width(), self.STEP_HEIGHT))
-                rectcolor = gui.C_PRIMARY
-                if col % 4 == 0:
-                    rectcolor = gui.C_DARKER
-                if curstep == col + self.measure * self.width:
-                    rectcolor = gui.C_LIGHTEST
-                pygame.draw.rect(surface, rectcolor, rect, not bool(data))
-                if data is not None and data != ' ':
-                    text = self.font.render(data, False, gui.C_DARKEST)
-                    surface.blit(text, pos)
+        if self.background is None:
+            self.background = self.render_background()
+        surface.blit(self.background, (0, 0))
+        if self.playhead is not None:
+            self.render_column(surface, self.playhead, True)
         return surface
 
+    def _render_dirty(self, surface, rects):
+        """Redraw the columns in rects."""
+        for rect in rects:
+            surface.blit(self.background, rect, rect)
+        if self.playhead is not None:
+            self.render_column(surface, self.playhead, True)
+
+    def render_background(self):
+        """Render the steps of the measure shown."""
+        background = pygame.Surface((gui.SCREEN_WIDTH,
+                                     len(self.rows) * self.STEP_HEIGHT))
+        background.fill(gui.C_LIGHTER)
+        first = self.measure * self.width
+        for col in range(first, first + self.width):
+            self.render_column(background, col)
+        return background
+
+    def render_column(self, surface, col, playing=False):
+        """Render the steps of column col of the part."""
+        for row in range(len(self.grid)):
+            data = self.grid[row][col]
+            pos = ((col % self.width) * self.step_width(),
+                   row * self.STEP_HEIGHT)
+            rect = pygame.Rect(pos, (self.step_width(), self.STEP_HEIGHT))
+            rectcolor = gui.C_PRIMARY
+            if col % 4 == 0:
+                rectcolor = gui.C_DARKER
+            if playing:
+                rectcolor = gui.C_LIGHTEST
+            pygame.draw.rect(surface, rectcolor, rect, not bool(data))
+            if data is not None and data != ' ':
+                text = gui.render_text(self.font, data, gui.C_DARKEST)
+                surface.blit(text, pos)
+
     def focus(self, *args, **kwargs):
         self.part_to_grid()
 
@@ -314,10 +371,10 @@ class RowEditor(screen.Screen):
                 # Play the virtual keyboard
                 elif note is not None:
                     msg = self.seqdrum.part.channel + midi.NOTE_ON
-                    ts = pygame.midi.time()
-                    data = [[[msg, note, 127], ts],
-                            [[msg, note, 0], ts + 500]]
-                    midi.out.write(data)
+                    ts = midi.time()
+                    port = self.seqdrum.part.port
+                    midi.write([msg, note, 127], ts, port=port)
+                    midi.write([msg, note, 0], ts + 500, port=port)
                     self.note = note
 
     def _render(self, surface):
@@ -330,7 +387,7 @@ class RowEditor(screen.Screen):
             pygame.draw.rect(surface, rectcolor, rect, self.row != i)
             string = ', '.join(['{}={}'.format(c, n)
                                 for c, n in self.seqdrum.rows[i].iteritems()])
-            text = self.rowfont.render(string, False, gui.C_DARKEST)
+            text = gui.render_text(self.rowfont, string, gui.C_DARKEST)
             surface.blit(text, (self.STEP_SIZE + 3, i * self.STEP_SIZE + 7))
         self.modeline.render(surface)
         return surface
@@ -36,6 +36,7 @@ class ModelineSections(IntEnum):
     Measure = 0
     Root = 1
     KeyboardMode = 2
+    Quantize = 3
 
 
 class SeqGrid(screen.Screen):
@@ -74,11 +75,16 @@ class SeqGrid(screen.Screen):
                    3: 1,
                    4: 0.5}
 
+    # Quantization of recorded notes, in 16ths: off, 1/16 and 1/32
+    QUANTIZE_GRIDS = (None, 1, 0.5)
+    QUANTIZE_STRENGTHS = (1.0, 0.75, 0.5, 0.25)
+
     MENU_WIDTH = 133
     GRID_WIDTH = gui.SCREEN_WIDTH - MENU_WIDTH
 
     def __init__(self, part, width=4, height=4,
-                 kb_root=60, kb_mode=KeyboardMode.Tap):
+                 kb_root=60, kb_mode=KeyboardMode.Tap,
+                 quantize=None, strength=1.0):
         self.part = part
         self.modeline = Modeline(len(ModelineSections))
         self.set_grid(width, height)
@@ -91,6 +97,17 @@ class SeqGrid(screen.Screen):
         self.midi_in_notes_pressed = set([])
         km_modeline_element = ModelineSections.KeyboardMode
         self.modeline.strings[km_modeline_element] = self.keyboard_mode.name
+        if quantize not in self.QUANTIZE_GRIDS:
+            quantize = None
+        self.quantize_grid = quantize
+        # The nearest strength there is, for values set by hand in a project
+        self.quantize_strength = min(self.QUANTIZE_STRENGTHS,
+                                     key=lambda s: abs(s - strength))
+        self.update_quantize_modeline()
+        # The notes recorded since the sequencer started, as
+        # [event, position played at, tick placed at]
+        self.take = []
+        self.take_changed = False
 
         # Menu
         SPACE = 2
@@ -199,23 +216,36 @@ class SeqGrid(screen.Screen):
 
         self.grid = [[pygame.Rect((x * step_w, y * step_h), step_size)
                       for y in range(height)] for x in range(width)]
+        self.playhead = None
 
     def step_timestamp(self, x, y):
         measure_steps = len(self.grid) * len(self.grid[0])
         return x + y * len(self.grid) + measure_steps * self.measure
 
-    def step_events(self, x, y, type=None):
+    def step_events(self, x, y, kind=None):
         """Return events at step x, y."""
-        ts = self.step_timestamp(x, y)
-        return [e for e in self.part.events(type) if int(e.timestamp) == ts]
+        return self.part.step_events(self.step_timestamp(x, y), kind)
 
-    def selected_events(self, type=None):
-        """Return a list of all selected events of a specific type."""
+    def selected_events(self, kind=None):
+        """Return a list of all selected events of a specific kind."""
         return [e for step in self.selected
                 for i, e in (enumerate(self.step_events(*step.pos())))
-                if (e.type() == type
+                if (e.kind == kind
                     and (step.index < 0 or step.index == i))]
 
+    def playhead_step(self):
+        """The grid position (x, y) of the playing step, None if it isn't in
+        the shown measure."""
+        playback = sequencer.playback
+        if not playback.running:
+            return None
+        cols = len(self.grid)
+        rows = len(self.grid[0])
+        curstep = int(playback.running_time % self.part.length)
+        if curstep // (cols * rows) != self.measure:
+            return None
+        return (curstep % cols, (curstep // cols) % rows)
+
     def step_at_pos(self, pos):
         """Get step at pos' grid position as a (x, y) tuple."""
         cols = len(self.grid)
@@ -246,7 +276,7 @@ class SeqGrid(screen.Screen):
         # Hold E and click step to set "end" (length)
         elif keys[pygame.K_e] and len(self.selected) == 1:
             new_ts = self.step_timestamp(x, y)
-            for e in self.selected_events('note_on'):
+            for e in self.selected_events(event.NOTE_ON):
                 e.length = new_ts + 1 - e.timestamp
                 self.last_length = e.length
         else:
@@ -272,15 +302,15 @@ class SeqGrid(screen.Screen):
 
         self.refresh_slider(step_to_update)
 
-    def delete_step(self, x, y, type=None):
-        """Delete all events of given type at self.grid[x][y]."""
-        for e in self.step_events(x, y, type=type):
+    def delete_step(self, x, y, kind=None):
+        """Delete all events of given kind at self.grid[x][y]."""
+        for e in self.step_events(x, y, kind=kind):
             self.part.delete(e)
 
     def delete_selected(self):
         for x, y, index in self.selected:
             if index < 0:
-                self.delete_step(x, y, type='note_on')
+                self.delete_step(x, y, kind=event.NOTE_ON)
                 continue
             events = self.step_events(x, y)
             if len(events):
@@ -293,9 +323,7 @@ class SeqGrid(screen.Screen):
         if length is None:
             length = self.last_length
         ts = self.step_timestamp(x, y) + offset
-        note_event = event.Event(ts,
-                                 event.note_on,
-                                 [note, velocity, length])
+        note_event = event.NoteOn(ts, note, velocity, length)
         self.part.append(note_event)
 
     def keyboard_mode_cycle(self):
@@ -306,13 +334,76 @@ class SeqGrid(screen.Screen):
         self.modeline.strings[km_modeline_element] = self.keyboard_mode.name
         self.key_notes_pressed = []
 
+    def quantize_cycle(self):
+        """Cycle between quantization grids."""
+        i = self.QUANTIZE_GRIDS.index(self.quantize_grid) + 1
+        self.quantize_grid = self.QUANTIZE_GRIDS[i % len(self.QUANTIZE_GRIDS)]
+        self.update_quantize_modeline()
+        self.take_changed = True
+
+    def quantize_strength_cycle(self):
+        """Cycle between quantization strengths."""
+        strengths = self.QUANTIZE_STRENGTHS
+        i = strengths.index(self.quantize_strength) + 1
+        self.quantize_strength = strengths[i % len(strengths)]
+        self.update_quantize_modeline()
+        self.take_changed = True
+
+    def update_quantize_modeline(self):
+        if self.quantize_grid is None:
+            quantize_string = 'Q off'
+        else:
+            quantize_string = 'Q 1/{} {}%'.format(
+                int(16 / self.quantize_grid),
+                int(self.quantize_strength * 100))
+        self.modeline[ModelineSections.Quantize] = quantize_string
+
+    def part_position(self, ms):
+        """The position in the part (in 16ths) played at PortMidi time ms."""
+        steps = sequencer.tick_at(ms) / float(sequencer.TICKS_PER_STEP)
+        return steps % self.part.length
+
+    def record_note(self, note, velocity, start, length):
+        """Add a recorded note to the take, where it was played.
+
+        It's quantized by quantize_take at the end of the frame.
+        """
+        note_event = event.NoteOn(start, note, velocity, length)
+        self.part.append(note_event)
+        self.take.append([note_event, start, note_event.tick])
+        self.take_changed = True
+
+    def quantize_take(self):
+        """Move the notes of the take to their quantized positions.
+
+        The take keeps the positions the notes were played at, so it's
+        quantized again from those when the quantization changes. Notes
+        deleted or moved in the grid since are left out of the take.
+        """
+        recorded = set(id(e) for e in self.part.events(event.NOTE_ON))
+        take = []
+        for entry in self.take:
+            note_event, start, placed = entry
+            if id(note_event) not in recorded or note_event.tick != placed:
+                continue
+            ts = sequencer.quantize(start, self.quantize_grid,
+                                    self.quantize_strength)
+            self.part.delete(note_event)
+            note_event.timestamp = ts
+            self.part.append(note_event)
+            entry[2] = note_event.tick
+            take.append(entry)
+        self.take = take
+        self.take_changed = False
+
     def keyboard_play(self, note):
         """Act on the keyboard note played, depend on self.keyboard_mode."""
         self.has_changed = True
 
         if(not sequencer.running or
            self.keyboard_mode is not KeyboardMode.Step):
-            midi.out.write_short(self.part.channel + midi.NOTE_ON, note, 127)
+            midi.write([self.part.channel + midi.NOTE_ON, note, 127],
+                       port=self.part.port)
 
         if self.keyboard_mode is KeyboardMode.Step:
             self.key_notes_pressed.append(note)
@@ -323,11 +414,9 @@ class SeqGrid(screen.Screen):
                     self.new_note_at_step(note, *self.selected[0].pos())
                 return
 
-            ts = int(round(sequencer.running_time)) % self.part.length
-            note_event = event.Event(ts,
-                                     event.note_on,
-                                     [note, self.last_vel, self.last_length])
-            self.part.append(note_event)
+            self.record_note(note, self.last_vel,
+                             self.part_position(midi.time()),
+                             self.last_length)
 
     def keydown_events(self, keyevents):
         """Handle pygame keydown events."""
@@ -336,11 +425,14 @@ class SeqGrid(screen.Screen):
             if mods & pygame.KMOD_SHIFT:
                 # Transpose selected steps one octave
                 if e.key == pygame.K_PLUS:
-                    for e in self.selected_events('note_on'):
+                    for e in self.selected_events(event.NOTE_ON):
                         e.note += 12
                 elif e.key == pygame.K_MINUS:
-                    for e in self.selected_events('note_on'):
+                    for e in self.selected_events(event.NOTE_ON):
                         e.note -= 12
+                # Cycle quantization strength
+                elif e.key == pygame.K_q:
+                    self.quantize_strength_cycle()
             elif mods & pygame.KMOD_CTRL:
                 pass
             elif mods & pygame.KMOD_ALT:
@@ -369,6 +461,9 @@ class SeqGrid(screen.Screen):
                 # Cycle keyboard mode
                 elif e.key == pygame.K_SLASH or e.key == pygame.K_t:
                     self.keyboard_mode_cycle()
+                # Cycle quantization
+                elif e.key == pygame.K_q:
+                    self.quantize_cycle()
                 # Next measure
                 elif e.key == pygame.K_DOWN:
                     self.measure += 1
@@ -383,10 +478,10 @@ class SeqGrid(screen.Screen):
                     screen.stack.append(ClipSettings(self))
                 # Transpose selected steps one semitone
                 elif e.key == pygame.K_PLUS:
-                    for e in self.selected_events('note_on'):
+                    for e in self.selected_events(event.NOTE_ON):
                         e.note += 1
                 elif e.key == pygame.K_MINUS:
-                    for e in self.selected_events('note_on'):
+                    for e in self.selected_events(event.NOTE_ON):
                         e.note -= 1
 
     def keyup_events(self, keyevents):
@@ -395,26 +490,29 @@ class SeqGrid(screen.Screen):
                and len(self.key_notes_pressed)):
                 self.key_notes_pressed.sort()
                 for x, y, index in self.selected:
-                    self.delete_step(x, y, 'note_on')
+                    self.delete_step(x, y, event.NOTE_ON)
                     for note in self.key_notes_pressed:
                         self.new_note_at_step(note, x, y)
             self.key_notes_pressed = []
 
             if e.key in self.KEYBOARD_KEYS:
                 note = self.keyboard_root + self.KEYBOARD_KEYS[e.key]
-                midi.out.write_short(self.part.channel + midi.NOTE_ON, note, 0)
+                midi.write([self.part.channel + midi.NOTE_ON, note, 0],
+                           port=self.part.port)
 
     def refresh_slider(self, step=None):
         """Update shown slider data."""
         self.has_changed = True
         if step is not None:
             if self.radios.selected == Radio.CC:
-                for i, e in enumerate(self.step_events(step.x, step.y, 'cc')):
+                cc_events = self.step_events(step.x, step.y, event.CC)
+                for i, e in enumerate(cc_events):
                     if step.index >= 0 and i != step.index:
                         self.slider.set_value(e.data, 127)
                         return
                 return
-            for i, e in enumerate(self.step_events(step.x, step.y, 'note_on')):
+            note_events = self.step_events(step.x, step.y, event.NOTE_ON)
+            for i, e in enumerate(note_events):
                 if step.index >= 0 and i != step.index:
                     continue
                 if self.radios.selected == Radio.Velocity:
@@ -465,7 +563,7 @@ class SeqGrid(screen.Screen):
                 if self.radios.selected == Radio.Velocity:
                     self.slider.set_value(self.VEL_PRESETS[presetclick], 127)
                 elif self.radios.selected == Radio.Length:
-                    for e in self.selected_events('note_on'):
+                    for e in self.selected_events(event.NOTE_ON):
                         # Dotted
                         if presetclick == 5:
                             e.length *= 1.5
@@ -481,19 +579,19 @@ class SeqGrid(screen.Screen):
             if self.radios.selected == Radio.CC:
                 cc_val = int(127 * self.slider.get_data())
                 self.last_cc = cc_val
-                # cc_events = self.selected_events('cc')
+                # cc_events = self.selected_events(event.CC)
                 cc_number = self.part.cc[self.cc_list.selected][0]
                 if slided:
                     # New CC events
                     for step in self.selected:
-                        for e in self.step_events(step.x, step.y, 'cc'):
+                        for e in self.step_events(step.x, step.y, event.CC):
                             if e.cc == cc_number:
                                 e.data = cc_val
                                 break
                         else:
                             ts = self.step_timestamp(step.x, step.y)
-                            new_cc_event = event.Event(ts, event.cc,
-                                                       [cc_number, cc_val])
+                            new_cc_event = event.ControlChange(ts, cc_number,
+                                                              cc_val)
                             self.part.append(new_cc_event)
                 return
 
@@ -502,7 +600,7 @@ class SeqGrid(screen.Screen):
             if self.radios.selected == Radio.Velocity:
                 self.last_vel = vel
 
-            for e in self.selected_events('note_on'):
+            for e in self.selected_events(event.NOTE_ON):
                 if self.radios.selected == Radio.Velocity:
                     e.velocity = vel
                 elif self.radios.selected == Radio.Length:
@@ -514,10 +612,10 @@ class SeqGrid(screen.Screen):
 
     def handle_midi_in(self):
         for e in midi.note_on_events():
-            midi.out.write_short(e.status + self.part.channel,
-                                 e.data1,
-                                 e.data2)
-            ts = int(round(sequencer.running_time)) % self.part.length
+            self.has_changed = True
+            midi.write([e.status + self.part.channel, e.data1, e.data2],
+                       port=self.part.port)
+            ts = self.part_position(e.timestamp)
             self.midi_in_notes_pressed.add((ts, e.data1, e.data2))
             if(self.selected and (self.keyboard_mode is KeyboardMode.Step or
                                   self.keyboard_mode is KeyboardMode.RealTime and
@@ -526,9 +624,9 @@ class SeqGrid(screen.Screen):
                                       velocity=e.data2)
 
         for e in midi.note_off_events():
-            midi.out.write_short(e.status + self.part.channel,
-                                 e.data1,
-                                 e.data2)
+            self.has_changed = True
+            midi.write([e.status + self.part.channel, e.data1, e.data2],
+                       port=self.part.port)
 
             to_remove = []
             for pressed in self.midi_in_notes_pressed:
@@ -536,21 +634,18 @@ class SeqGrid(screen.Screen):
                 if note == e.data1:
                     if(self.keyboard_mode == KeyboardMode.RealTime and
                        sequencer.running):
-                        end_ts = sequencer.running_time % self.part.length
+                        end_ts = self.part_position(e.timestamp)
                         if end_ts < ts:
                             end_ts += self.part.length
                         length = end_ts - ts
                         if length > self.part.length:
                             length = self.part.length - 0.1
-                        note_event = event.Event(ts,
-                                                 event.note_on,
-                                                 [note, vel, length])
-                        self.part.append(note_event)
+                        self.record_note(note, vel, ts, length)
                     to_remove.append(pressed)
             self.midi_in_notes_pressed.difference_update(to_remove)
 
     def _update(self, events):
-        self.has_changed = sequencer.new_step
+        self.has_changed = screen.has_input(events)
 
         self.keydown_events((e for e in events if e.type == pygame.KEYDOWN))
         self.keyup_events((e for e in events if e.type == pygame.KEYUP))
@@ -560,6 +655,10 @@ class SeqGrid(screen.Screen):
 
         # keys = pygame.key.get_pressed()
         self.handle_midi_in()
+        if self.take_changed:
+            self.quantize_take()
+        if not sequencer.running:
+            self.take = []
 
         for e in events:
             if e.type == pygame.MOUSEBUTTONDOWN:
@@ -577,26 +676,31 @@ class SeqGrid(screen.Screen):
                         new_ts = self.step_timestamp(*step)
                         self.delete_step(*step)
                         for ev in self.step_events(*self.step_dragged):
-                            copy = event.Event(new_ts + ev.timestamp % 1,
-                                               ev.function,
-                                               ev.params)
+                            copy = ev.copy(new_ts + ev.timestamp % 1)
                             self.part.append(copy)
                 self.step_dragged = None
 
+        # Only the steps the playhead left and entered need redrawing
+        playhead = self.playhead_step()
+        if playhead != self.playhead:
+            for step in (self.playhead, playhead):
+                if step is not None:
+                    self.mark_dirty(self.grid[step[0]][step[1]])
+            self.playhead = playhead
+
     def render_step_events(self, surface, x, y):
         xpos, ypos = self.grid[x][y].topleft
         for i, e in enumerate(self.step_events(x, y)):
             string = '???'
-            event_type = e.type()
-            if event_type == 'note_on':
+            if e.kind == event.NOTE_ON:
                 string = midi.note_to_string(e.note)
-            elif event_type == 'cc':
+            elif e.kind == event.CC:
                 string = '{}={}'.format(e.cc, e.data)
             color = gui.C_DARKEST
             if (x, y) in [step.pos() for step in self.selected
                           if step.index < 0 or step.index == i]:
                 color = gui.C_LIGHTEST
-            text = self.font.render(string, False, color)
+            text = gui.render_text(self.font, string, color)
             surface.blit(text, (xpos + 2, ypos + 2))
             ypos += text.get_rect().height
 
@@ -608,14 +712,14 @@ class SeqGrid(screen.Screen):
         grid_width = cols * step_width  # self.GRID_WIDTH seems to be off
 
         for step in self.selected:
-            if not self.step_events(step.x, step.y, 'note_on'):
+            if not self.step_events(step.x, step.y, event.NOTE_ON):
                 continue
 
             xpos, ypos = self.grid[step.x][step.y].topleft
 
             if self.radios.selected == Radio.Length:
                 ypos += step_height * 0.25
-                for e in self.step_events(step.x, step.y, 'note_on'):
+                for e in self.step_events(step.x, step.y, event.NOTE_ON):
                     pixel_length = e.length * step_width
                     break
                 while xpos + pixel_length >= grid_width:
@@ -638,27 +742,23 @@ class SeqGrid(screen.Screen):
                                       step_height * self.slider.get_data())
                 pygame.draw.rect(surface, gui.C_DARKER, velrect, False)
 
+    def render_step(self, surface, x, y):
+        """Render the rectangle of step x, y."""
+        rectcolor = gui.C_PRIMARY
+        filled = (x, y) in [s.pos() for s in self.selected]
+        if (x, y) == self.playhead:
+            rectcolor = gui.C_DARKEST
+            filled = True
+        pygame.draw.rect(surface, rectcolor, self.grid[x][y], 1 - filled)
+
     def _render(self, surface):
         cols = len(self.grid)
         rows = len(self.grid[0])
 
-        curstep = int(sequencer.running_time % self.part.length)
-        current_measure = curstep // (cols * rows)
-        # The current active step position
-        current_y = (curstep // cols) % rows
-        current_x = curstep % cols
-
         # Render rectangles
         for x in range(cols):
             for y in range(rows):
-                rect = self.grid[x][y]
-                rectcolor = gui.C_PRIMARY
-                filled = (x, y) in [s.pos() for s in self.selected]
-                if current_measure == self.measure and sequencer.running:
-                    if (current_x, current_y) == (x, y):
-                        rectcolor = gui.C_DARKEST
-                        filled = True
-                pygame.draw.rect(surface, rectcolor, rect, 1 - filled)
+                self.render_step(surface, x, y)
 
         self.render_selected_steps_data(surface)
 
@@ -677,6 +777,19 @@ class SeqGrid(screen.Screen):
 
         return surface
 
+    def _render_dirty(self, surface, rects):
+        """Redraw the steps in rects."""
+        for rect in rects:
+            x, y = self.step_at_pos(rect.topleft)
+            surface.set_clip(rect)
+            surface.fill(gui.C_LIGHTER)
+            self.render_step(surface, x, y)
+            self.render_selected_steps_data(surface)
+            # Event text may run over from the steps above
+            for row in range(y + 1):
+                self.render_step_events(surface, x, row)
+        surface.set_clip(None)
+
 
 # YAML SeqGrid representation
 def seqgrid_representer(dumper, data):
@@ -684,13 +797,16 @@ def seqgrid_representer(dumper, data):
                'width': len(data.grid),
                'height': len(data.grid[0]),
                'root': data.keyboard_root,
-               'mode': data.keyboard_mode}
+               'mode': data.keyboard_mode,
+               'quantize': data.quantize_grid,
+               'strength': data.quantize_strength}
     return dumper.represent_mapping(u'!seqgrid', mapping)
 
 
 def seqgrid_constructor(loader, node):
     m = loader.construct_mapping(node)
-    return SeqGrid(m['part'], m['width'], m['height'], m['root'], m['mode'])
+    return SeqGrid(m['part'], m['width'], m['height'], m['root'], m['mode'],
+                   m.get('quantize'), m.get('strength', 1.0))
 
 editors.editors.append(["Grid", SeqGrid])
 yaml.add_representer(SeqGrid, seqgrid_representer)
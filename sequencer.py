@@ -1,19 +1,67 @@
 import midi
 
-import pygame.time
 import bisect
+import heapq
+import itertools
+import os
+import threading
+import time
 import yaml
 
+from array import array
+from collections import namedtuple
+
 MC_NONE = 0
 MC_SEND = 1
 MC_RECIEVE = 2
-
-clock_time = 0  # in ms since start
-running_time = 0  # 16th notes pased since start
-clock = pygame.time.Clock()
+MC_NAMES = {'none': MC_NONE, 'send': MC_SEND, 'receive': MC_RECIEVE}
+
+# The engine counts integer ticks. The tick counter is advanced from the
+# elapsed time, so tempo changes never make the song position jump.
+PPQ = 96
+TICKS_PER_STEP = PPQ // 4
+tick = 0  # ticks passed since start
+tick_fraction = 0.0  # the part of a tick passed since tick
+last_ms = 0  # PortMidi time of the last update
+running_time = 0  # 16th notes pased since start, for the UI
+
+# Events are scheduled ahead of time and sent with PortMidi timestamps. The
+# schedule_tick cursor is tick plus the lookahead.
+lookahead = 0  # in ms
+schedule_tick = 0  # ticks scheduled since start
+event_tick = None  # the song position of the event being triggered
 running = False
 midiclock = MC_SEND
-new_step = False
+
+# MIDI clock send. While running, every pulse up to schedule_tick is sent
+# with the timestamp of its song tick, just like the notes. While stopped,
+# the clock keeps running at the current tempo, without lookahead.
+clock_next_tick = 0  # song tick of the next pulse to send
+clock_next_ms = 0  # PortMidi time of the next pulse to send while stopped
+
+# MIDI clock receive. The received pulses are run through a phase-locked
+# loop, estimating the time of the latest pulse and the time between pulses.
+CLOCK_TICKS = PPQ // 24  # ticks per MIDI clock pulse
+CLOCK_PHASE_GAIN = 0.25
+CLOCK_PERIOD_GAIN = 0.03
+clock_armed = False  # start playing at the next pulse?
+clock_base = 0  # song tick of the first pulse since playing started
+clock_pulses = 0  # pulses since clock_base
+clock_phase = None  # estimated PortMidi time of the latest pulse
+clock_period = None  # estimated ms between pulses
+clock_bpm = None  # tempo of the received clock
+
+# The engine may run on its own thread. Everything touching the playback state
+# (the engine itself, and the UI when handling input) must hold the lock.
+ENGINE_INTERVAL = 0.001  # seconds to sleep between engine wake-ups
+ENGINE_PRIORITY = 50  # SCHED_FIFO priority, if we're allowed to get it
+lock = threading.RLock()
+engine = None
+engine_running = False
+
+# A consistent view of the playback state, used by the UI when rendering.
+Playback = namedtuple('Playback', 'running running_time new_step scene')
+playback = Playback(False, 0, False, 0)
 
 project = {'name': 'Unnamed',
            'path': None,
@@ -23,6 +71,12 @@ project = {'name': 'Unnamed',
 current_scene = 0
 goto_scene = None
 
+# The parts of the current scene in a heap of (tick, order, part), ordered by
+# the song tick at which they next have something to do.
+timeline = []
+timeline_order = itertools.count()
+timeline_dirty = True
+
 
 def scene(scene_nr=None):
     """Get scene[scene_nr] from the project.
@@ -36,105 +90,556 @@ def scene(scene_nr=None):
 
 def _switch_scene():
     global current_scene, goto_scene
-    from screen import stack
+    if running:
+        for part in parts():
+            part.stop()
     current_scene = goto_scene
     goto_scene = None
-    topclass = stack.top()
-    if topclass.__class__.__name__ == 'SceneView':
-        topclass.update_partrects()
-    scene = 'Scene {}/{}'.format(current_scene + 1, len(project['scenes']))
-    topclass.modeline[0] = scene
+    if running:
+        for part in parts():
+            part.start()
 
 
 def start():
-    """Start the sequencer."""
-    global running
+    """Start the sequencer.
+
+    If slaved to a received MIDI clock, start at the next clock pulse.
+    """
+    global running, last_ms, clock_armed, clock_next_tick
+    if midiclock == MC_RECIEVE:
+        clock_armed = True
+        return
     running = True
+    last_ms = midi.time()
+    invalidate()
+    clock_next_tick = 0
     if midiclock == MC_SEND:
-        midi.out.write_short(midi.MC_START)
+        midi.write([midi.MC_START], port=midi.ALL_PORTS)
     for part in parts():
         part.start()
 
 
 def stop():
     """Stop the sequencer."""
-    global clock_time, running_time, running, new_step
-    clock_time = 0
-    running_time = 0
-    running = False
-    new_step = False
-
+    global tick, tick_fraction, schedule_tick, running_time, running
     if midiclock == MC_SEND:
-        midi.out.write_short(midi.MC_STOP)
-
+        _stop_clock()
     for part in parts():
         part.stop()
 
+    tick = 0
+    tick_fraction = 0.0
+    schedule_tick = 0
+    running_time = 0
+    running = False
+
 
 def toggle():
     """Starts/stops the sequencer."""
     stop() if running else start()
 
 
+def pause():
+    """Stop the sequencer, but keep the song position."""
+    global running, schedule_tick
+    if midiclock == MC_SEND:
+        _stop_clock()
+    for part in parts():
+        part.stop()
+    running = False
+    schedule_tick = tick
+
+
+def resume():
+    """Start the sequencer from the current song position."""
+    global running, last_ms, clock_next_tick
+    if midiclock == MC_SEND:
+        # Song position pointers can only point at 16ths
+        locate(tick // TICKS_PER_STEP * TICKS_PER_STEP)
+        clock_next_tick = tick
+        position = tick // TICKS_PER_STEP
+        midi.write([midi.MC_SONG_POSITION, position & 0x7f, position >> 7],
+                   port=midi.ALL_PORTS)
+        midi.write([midi.MC_CONTINUE], port=midi.ALL_PORTS)
+    running = True
+    last_ms = midi.time()
+    invalidate()
+    for part in parts():
+        part.start()
+
+
+def panic():
+    """Silence everything, also the notes scheduled ahead.
+
+    The parts forget the note offs they were waiting for, since panic has
+    already stopped those notes.
+    """
+    with lock:
+        for scene in project['scenes']:
+            for clip in scene:
+                clip.part.future_events.clear()
+        midi.panic()
+
+
+def toggle_pause():
+    """Pauses/continues the sequencer."""
+    pause() if running else resume()
+
+
+def locate(song_tick):
+    """Set the song position while the sequencer isn't running."""
+    global tick, tick_fraction, schedule_tick, running_time
+    tick = song_tick
+    tick_fraction = 0.0
+    schedule_tick = song_tick
+    running_time = tick / float(TICKS_PER_STEP)
+
+
 def parts():
     return [clip.part for clip in project['scenes'][current_scene]]
 
 
+def invalidate():
+    """Rebuild the timeline at the next update.
+
+    Should be run when parts are added to or removed from the current scene,
+    or when a part's events have changed.
+    """
+    global timeline_dirty
+    timeline_dirty = True
+
+
+def _build_timeline():
+    global timeline, timeline_dirty
+    timeline = [(part.next_due(), next(timeline_order), part)
+                for part in parts()]
+    heapq.heapify(timeline)
+    timeline_dirty = False
+
+
+def _update_parts():
+    """Update the parts which have something due up to schedule_tick."""
+    if timeline_dirty or len(timeline) != len(scene()):
+        _build_timeline()
+    while timeline and timeline[0][0] <= schedule_tick:
+        part = heapq.heappop(timeline)[2]
+        scene_before = current_scene
+        part.update()
+        # A part may switch scene or change variant when it loops
+        if timeline_dirty or current_scene != scene_before:
+            _build_timeline()
+        else:
+            heapq.heappush(timeline,
+                           (part.next_due(), next(timeline_order), part))
+
+
+def to_ticks(steps):
+    """Convert a length or timestamp in 16ths to ticks."""
+    return int(round(steps * TICKS_PER_STEP))
+
+
+def quantize(position, grid, strength=1.0):
+    """Move position towards the nearest multiple of grid.
+
+    strength is how far to move it, from 0.0 (not at all) to 1.0 (all the
+    way). A grid of None leaves position as it is.
+    """
+    if not grid:
+        return position
+    nearest = round(position / float(grid)) * grid
+    return position + (nearest - position) * strength
+
+
+def bpm():
+    """The current tempo, which is the received one if slaved."""
+    if midiclock == MC_RECIEVE and clock_bpm is not None:
+        return clock_bpm
+    return project['bpm']
+
+
+def ticks_per_ms():
+    """Ticks per ms at the current tempo."""
+    return bpm() * PPQ / 60000.0
+
+
+def tick_at(ms):
+    """The song position (in ticks, not rounded) at PortMidi time ms."""
+    return tick + tick_fraction + (ms - last_ms) * ticks_per_ms()
+
+
+def ms_at(song_tick):
+    """The PortMidi time at which the song reaches song_tick."""
+    return int(round(last_ms +
+                     (song_tick - tick - tick_fraction) / ticks_per_ms()))
+
+
+def event_timestamp():
+    """PortMidi timestamp of the event being triggered.
+
+    None if no event is being triggered by the engine, meaning that the
+    event should be sent immediately.
+    """
+    if event_tick is None:
+        return None
+    return ms_at(event_tick)
+
+
+def event_position():
+    """Song position (in ticks) of the event being triggered, or now."""
+    if event_tick is None:
+        return tick
+    return event_tick
+
+
 def save(path):
-    """The path is relative to the projects folder."""
+    """The path is relative to the projects folder.
+
+    Only the UI changes what is saved, so the lock isn't needed.
+    """
     with open(path, 'w') as f:
         yaml.dump(project, f)
 
 
 def load(path):
+    """Load the project in path. The file is read without the lock held."""
     global project
     with open(path, 'r') as f:
+        loaded = yaml.load(f)
+    with lock:
         stop()
-        project = yaml.load(f)
+        project = loaded
         start()
 
 
 def update():
     """Update the sequencer.
 
-    Should be run every frame if the sequencer has started.
+    Run by the engine thread, or every frame if the engine isn't threaded.
+    The caller must hold the lock.
     """
-    global running_time, clock_time, new_step
-    delta = clock.tick()
-    bpm = project['bpm']
+    global tick, tick_fraction, last_ms, running_time, schedule_tick
 
+    now = midi.time()
+    if midiclock == MC_RECIEVE:
+        _receive_clock()
+    else:
+        midi.skip_clock()
     if running:
-        clock_time += delta * 0.001
-        old_running_time = int(running_time)
-        running_time = clock_time / ((60.0 / bpm) / 4.0)
-        new_step = old_running_time != int(running_time)
-
-    if midiclock == MC_SEND and midi.out:
-        # 24 ppq
-        ppq_length = (60.0 / bpm) / 24.0
-        update.deltasum += delta * 0.001
-        if update.deltasum >= update.next_ppq:
-            midi.out.write_short(midi.MC_CLOCK)
-            update.next_ppq += ppq_length
-    # TODO: Recieve MIDI clock
+        if midiclock == MC_RECIEVE and clock_phase is not None:
+            ticks = max(_clock_position(now), tick + tick_fraction) - tick
+        else:
+            ticks = (now - last_ms) * ticks_per_ms() + tick_fraction
+        tick += int(ticks)
+        tick_fraction = ticks - int(ticks)
+        running_time = tick / float(TICKS_PER_STEP)
+        schedule_tick = max(schedule_tick,
+                            tick + int(lookahead * ticks_per_ms()))
+    last_ms = now
 
-    for part in parts():
-        part.update()
+    if midiclock == MC_SEND:
+        _send_clock(now)
+
+    if running:
+        _update_parts()
+
+    midi.flush()
+
+
+def _send_clock(now):
+    """Send all clock pulses due up to the lookahead."""
+    global clock_next_tick, clock_next_ms
+    if running:
+        while clock_next_tick <= schedule_tick:
+            midi.write([midi.MC_CLOCK], ms_at(clock_next_tick), 'clock',
+                       midi.ALL_PORTS)
+            clock_next_tick += CLOCK_TICKS
+    else:
+        # Only send the pulses that are due, so that none are queued past
+        # the time the sequencer starts again.
+        period = CLOCK_TICKS / ticks_per_ms()
+        if clock_next_ms <= now - period:
+            clock_next_ms = now
+        while clock_next_ms <= now:
+            midi.write([midi.MC_CLOCK], int(round(clock_next_ms)), 'clock',
+                       midi.ALL_PORTS)
+            clock_next_ms += period
+
+
+def _stop_clock():
+    """Send clock stop, and keep the clock running after the pulses
+    already sent."""
+    global clock_next_ms
+    midi.write([midi.MC_STOP], port=midi.ALL_PORTS)
+    if running:
+        clock_next_ms = ms_at(clock_next_tick)
+
+
+def _receive_clock():
+    """Handle the clock messages received since the last update."""
+    global clock_armed, clock_base, clock_pulses
+    for e in midi.read_clock():
+        status = e.status
+        if status == midi.MC_CLOCK:
+            _clock_pulse(e.timestamp)
+            if clock_armed:
+                clock_armed = False
+                clock_base = tick
+                clock_pulses = 0
+                resume()
+        elif status == midi.MC_START:
+            stop()
+            clock_armed = True
+        elif status == midi.MC_CONTINUE:
+            clock_armed = True
+        elif status == midi.MC_STOP:
+            clock_armed = False
+            if running:
+                pause()
+        elif status == midi.MC_SONG_POSITION and not running:
+            # The position is given in 16ths
+            locate((e.data1 | e.data2 << 7) * TICKS_PER_STEP)
+
+
+def _clock_pulse(timestamp):
+    """Update the tempo and phase estimate with a received pulse."""
+    global clock_pulses, clock_phase, clock_period, clock_bpm
+    clock_pulses += 1
+    if clock_phase is None:
+        clock_period = 60000.0 / (project['bpm'] * 24)
+        clock_phase = timestamp
+    else:
+        error = timestamp - (clock_phase + clock_period)
+        if abs(error) > clock_period:
+            # Lost track, the clock may have been paused
+            clock_phase = timestamp
+        else:
+            clock_phase += clock_period + CLOCK_PHASE_GAIN * error
+            clock_period += CLOCK_PERIOD_GAIN * error
+    clock_bpm = 60000.0 / (clock_period * 24)
+
+
+def _clock_position(ms):
+    """The song position (in ticks, not rounded) at ms when slaved.
+
+    The position is interpolated between pulses, but never passes the next
+    pulse before it has been received.
+    """
+    since_pulse = (ms - clock_phase) / clock_period
+    since_pulse = min(max(since_pulse, 0.0), 1.0)
+    return clock_base + (clock_pulses + since_pulse) * CLOCK_TICKS
+
+
+def snapshot():
+    """Take a consistent snapshot of the playback state for the UI.
+
+    Should be run once per frame. Playback.new_step is True if the step has
+    changed since the last snapshot.
+    """
+    global playback
+    with lock:
+        new_step = running and int(running_time) != int(playback.running_time)
+        playback = Playback(running, running_time, new_step, current_scene)
+    return playback
+
+
+def _raise_priority():
+    """Try to get real-time scheduling for the calling thread."""
+    try:
+        param = os.sched_param(ENGINE_PRIORITY)
+        os.sched_setscheduler(0, os.SCHED_FIFO, param)
+    except (AttributeError, OSError):
+        pass
+
+
+def _engine_loop():
+    _raise_priority()
+    while engine_running:
+        with lock:
+            update()
+        time.sleep(ENGINE_INTERVAL)
+
+
+def threaded():
+    """Return True if the engine runs on its own thread."""
+    return engine is not None
+
+
+def start_engine():
+    """Run the engine on its own thread, decoupled from the frame rate."""
+    global engine, engine_running
+    if engine is not None:
+        return
+    engine_running = True
+    engine = threading.Thread(target=_engine_loop, name='engine')
+    engine.daemon = True
+    engine.start()
+
+
+def stop_engine():
+    """Stop the engine thread. Must not be called while holding the lock."""
+    global engine, engine_running
+    if engine is None:
+        return
+    engine_running = False
+    engine.join()
+    engine = None
+
+
+class FutureEvents(object):
+    """A priority queue of events to trigger later, ordered by tick.
+
+    Pending note offs are indexed by (channel, note), so that retriggering a
+    note can replace its note off in constant time. Replaced entries are left
+    in the heap and skipped when they come up.
+    """
+    # Heap entry fields
+    TICK, ORDER, EVENT, KEY = range(4)
+
+    def __init__(self):
+        self._heap = []
+        self._note_offs = {}
+        self._order = itertools.count()
+        self._live = 0
+
+    def __len__(self):
+        return self._live
+
+    def __iter__(self):
+        """Iterate over the pending events, in no particular order."""
+        return (entry[self.EVENT] for entry in self._heap
+                if entry[self.EVENT] is not None)
+
+    def push(self, event, key=None):
+        entry = [event.tick, next(self._order), event, key]
+        heapq.heappush(self._heap, entry)
+        self._live += 1
+        return entry
+
+    def push_note_off(self, channel, note, event):
+        """Add a note off, replacing any pending one for the same note."""
+        key = (channel, note)
+        old = self._note_offs.get(key)
+        if old is not None:
+            old[self.EVENT] = None
+            self._live -= 1
+        self._note_offs[key] = self.push(event, key)
+
+    def next_tick(self):
+        """The tick of the next pending event, None if there is none."""
+        heap = self._heap
+        while heap and heap[0][self.EVENT] is None:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][self.TICK]
+        return None
+
+    def note_offs(self):
+        """All pending note off events."""
+        return [entry[self.EVENT] for entry in self._note_offs.values()]
+
+    def pop_due(self, tick):
+        """Pop and yield the events due at or before tick, in order."""
+        heap = self._heap
+        while heap and heap[0][self.TICK] <= tick:
+            entry = heapq.heappop(heap)
+            event = entry[self.EVENT]
+            if event is None:
+                continue
+            self._live -= 1
+            key = entry[self.KEY]
+            if key is not None:
+                del self._note_offs[key]
+            yield event
+
+    def clear(self):
+        self._heap = []
+        self._note_offs = {}
+        self._live = 0
+
+
+class EventStore(object):
+    """The events of a variant, kept sorted by tick.
+
+    Ticks and kinds are stored in typed arrays alongside the event objects,
+    so that events are inserted in place and the playback cursor can be
+    relocated with bisect instead of sorting and scanning. The event data
+    stays in the event objects, since the editors modify them in place.
+    """
+    def __init__(self, events=()):
+        self.ticks = array('l')
+        self.kinds = array('B')
+        self.records = []
+        for e in sorted(events):
+            self.ticks.append(e.tick)
+            self.kinds.append(e.kind)
+            self.records.append(e)
 
-update.deltasum = 0
-update.next_ppq = 0
+    def __len__(self):
+        return len(self.records)
 
+    def __iter__(self):
+        return iter(self.records)
 
-# Timestamps are measured in 16ths
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def __repr__(self):
+        return repr(self.records)
+
+    def insert(self, event):
+        """Insert event after any events with the same tick."""
+        i = bisect.bisect_right(self.ticks, event.tick)
+        self.ticks.insert(i, event.tick)
+        self.kinds.insert(i, event.kind)
+        self.records.insert(i, event)
+
+    def remove(self, event):
+        i = bisect.bisect_left(self.ticks, event.tick)
+        while i < len(self.records) and self.records[i] is not event:
+            i += 1
+        if i == len(self.records):
+            # The timestamp has been changed since the event was inserted
+            i = self.records.index(event)
+        del self.ticks[i]
+        del self.kinds[i]
+        del self.records[i]
+
+    def truncate(self, tick):
+        """Remove all events at or after tick."""
+        i = bisect.bisect_left(self.ticks, tick)
+        del self.ticks[i:]
+        del self.kinds[i:]
+        del self.records[i:]
+
+    def of_kind(self, kind):
+        return [e for e, k in zip(self.records, self.kinds) if k == kind]
+
+    def between(self, start, end, kind=None):
+        """Events from tick start up to (but not including) tick end."""
+        i = bisect.bisect_left(self.ticks, start)
+        j = bisect.bisect_left(self.ticks, end, i)
+        if kind is None:
+            return self.records[i:j]
+        return [self.records[n] for n in range(i, j) if self.kinds[n] == kind]
+
+    def index_after(self, tick):
+        """Index of the first event after tick."""
+        return bisect.bisect_right(self.ticks, tick)
+
+    def index_at(self, tick):
+        """Index of the first event at or after tick."""
+        return bisect.bisect_left(self.ticks, tick)
+
+
+# Timestamps are measured in 16ths, the engine compares their ticks
 class Part(object):
     def __init__(self, name, length=16, channel=0,
-                 bank=0, program=0, cc=None, events=None, variant=0):
+                 bank=0, program=0, cc=None, events=None, variant=0, port=0):
         if events is None:
-            # Every element is a variant. A variant is a list of events,
-            # sorted by timestamp. 10 variants is possible per Part.
-            self._events = [list() for i in range(10)]
+            # Every element is a variant. 10 variants is possible per Part.
+            self._events = [EventStore() for i in range(10)]
         else:
-            self._events = events
+            self._events = [EventStore(v) for v in events]
         if cc is None:
             self.cc = [(i, '') for i in range(120)]
         else:
@@ -143,11 +648,10 @@ class Part(object):
         self.name = name
         self._variant = variant
 
-        self.future_events = []
+        self.future_events = FutureEvents()
         self._mute = False
-        self.next_timestamp = 0
-        self.element = -1  # the last element checked
-        self.finished = False  # the last event has triggered?
+        self.cursor = 0  # index of the next event to trigger
+        self._port = port  # the number of the MIDI out port
         self._channel = channel
         self.channel = channel
         self.bank = bank
@@ -177,11 +681,11 @@ class Part(object):
 
     @length.setter
     def length(self, value):
-        for variant_events in self._events:
-            if variant_events:
-                variant_events = [e for e in variant_events
-                                  if e.timestamp < value]
         self._length = value
+        self.length_ticks = to_ticks(value)
+        for variant_events in self._events:
+            variant_events.truncate(self.length_ticks)
+        invalidate()
 
     @property
     def channel(self):
@@ -192,95 +696,161 @@ class Part(object):
         self.stop()
         self._channel = value
 
+    @property
+    def port(self):
+        return self._port
+
+    @port.setter
+    def port(self, value):
+        self.stop()
+        self._port = value
+
     def _change_variant(self):
-        self.stop(kill_all=False)
+        self.stop()
         self._variant = self.switch_to_variant
         self.switch_to_variant = None
         self.start(program_change=False)
 
     def update(self):
-        """Update the part and trigger new events. Check if part has looped."""
-        global running_time, running, goto_scene
+        """Update the part and trigger new events. Check if part has looped.
 
-        timestamp = running_time % self.length
-        measure = running_time // self.length
+        Everything up to schedule_tick is triggered.
+        """
+        if not running:
+            return
 
-        # Check future events
-        if running:
-            while(self.future_events and
-                  self.future_events[0].timestamp <= running_time):
-                event = self.future_events[0]
-                event.call(self)
-                self.future_events.pop(0)
+        self._trigger_future(schedule_tick)
 
         # Part has looped?
-        if self.finished and measure != self.last_measure:
-            if self.toggle:
-                self.toggle = False
-                self.mute = not self.mute
-            if goto_scene is not None:
-                _switch_scene()
-            if self.switch_to_variant is not None:
-                self._change_variant()
-            self.finished = False
-
-        if not self._events[self._variant]:
-            if(self.switch_to_variant is not None
-               and measure != self.last_measure):
-                self._change_variant()
-            if(goto_scene is not None
-               and measure != self.last_measure):
-                _switch_scene()
+        measure = schedule_tick // self.length_ticks
+        if measure != self.last_measure:
+            if self.last_measure >= 0:
+                self._trigger_until(self.length_ticks, self.last_measure)
+                scene = current_scene
+                self._looped(measure)
+                self.cursor = 0
+                if current_scene != scene:
+                    return
             self.last_measure = measure
-            return
 
-        self.last_measure = measure
+        self._trigger_until(schedule_tick % self.length_ticks, measure)
 
-        if running and not self.finished and timestamp >= self.next_timestamp:
-            self._trigger_event()
-
-    def stop(self, kill_all=True):
-        """Stop all notes."""
-        for e in self.future_events:
-            if e.type() == 'note_off':
-                e.call(self)
-        if kill_all:
-            midi.out.write_short(midi.CC + self.channel, 120, 127)
-        self.future_events = []
+    def next_due(self):
+        """The song tick at which the part next has something to do."""
+        if self.last_measure < 0:
+            return 0
+        loop_start = self.last_measure * self.length_ticks
+        store = self._events[self._variant]
+        if self.cursor < len(store):
+            due = loop_start + store.ticks[self.cursor]
+        else:
+            due = loop_start + self.length_ticks
+        future = self.future_events.next_tick()
+        if future is not None and future < due:
+            return future
+        return due
+
+    def _looped(self, measure):
+        """Things that happen when the part starts over."""
+        global event_tick
+        event_tick = measure * self.length_ticks
+        if self.toggle:
+            self.toggle = False
+            self.mute = not self.mute
+        if goto_scene is not None:
+            _switch_scene()
+        if self.switch_to_variant is not None:
+            self._change_variant()
+        event_tick = None
+
+    def _trigger_future(self, song_tick):
+        """Trigger the future events up to and including song_tick."""
+        global event_tick
+        for event in self.future_events.pop_due(song_tick):
+            event_tick = event.tick
+            event.call(self)
+        event_tick = None
+
+    def _trigger_until(self, loop_tick, measure):
+        """Trigger the events of measure up to and including loop_tick."""
+        global event_tick
+        store = self._events[self._variant]
+        ticks = store.ticks
+        loop_start = measure * self.length_ticks
+        while self.cursor < len(ticks) and ticks[self.cursor] <= loop_tick:
+            if not self.mute:
+                song_tick = loop_start + ticks[self.cursor]
+                # Note offs that come before the event go first, in case
+                # the event turns the same note on again.
+                self._trigger_future(song_tick - 1)
+                event_tick = song_tick
+                store[self.cursor].call(self)
+            self.cursor += 1
+        event_tick = None
+
+    def stop(self):
+        """Stop the notes the part is playing.
+
+        Only the pending note offs are sent, after everything that is
+        already scheduled. Use panic() to silence everything.
+        """
+        global event_tick
+        position = event_tick
+        if position is None and running:
+            event_tick = schedule_tick
+        for e in self.future_events.note_offs():
+            e.call(self)
+        event_tick = position
+        self.future_events.clear()
 
     def start(self, program_change=True):
-        """When the part starts from the beginning."""
-        self.finished = False
-        self.last_measure = -1
-        self.element = -1
+        """When the part starts from the current song position.
+
+        If started by an event, like a scene switch when another part loops,
+        the part starts at the position of that event.
+        """
+        invalidate()
+        position = schedule_tick if event_tick is None else event_tick
+        self.last_measure = position // self.length_ticks
+        self.cursor = self._events[self._variant].index_at(
+            position % self.length_ticks)
         if program_change:
+            timestamp = event_timestamp()
             if self.bank > 0:
-                midi.out.write_short(midi.CC + self.channel, 32, self.bank - 1)
+                midi.write([midi.CC + self.channel, 32, self.bank - 1],
+                           timestamp, self.name, self.port)
             if self.program > 0:
-                midi.out.write_short(midi.PC + self.channel, self.program - 1)
-        try:
-            self.next_timestamp = self._events[self._variant][0].timestamp
-        except:
-            self.finished = True
+                midi.write([midi.PC + self.channel, self.program - 1],
+                           timestamp, self.name, self.port)
 
     def append_future(self, event):
-        bisect.insort(self.future_events, event)
+        self.future_events.push(event)
 
     def append(self, event):
         """Add new event to the part"""
         event.timestamp = event.timestamp % self.length
-        self._events[self._variant].append(event)
-        self._sort()
+        if event.tick >= self.length_ticks:
+            # Just before the loop point, rounded to the start of the loop
+            event.timestamp = 0
+        self._events[self._variant].insert(event)
+        self._seek()
 
     def delete(self, event):
         self._events[self._variant].remove(event)
-        self._sort()
+        self._seek()
+
+    def events(self, kind=None):
+        """Return all events of given kind. All events if kind==None."""
+        if kind is not None:
+            return self._events[self._variant].of_kind(kind)
+        return self._events[self._variant].records
 
-    def events(self, type=None):
-        """Return all events of given type. All events if type==None."""
-        if type:
-            return [e for e in self._events[self._variant] if e.type() == type]
-        return self._events[self._variant]
+    def step_events(self, step, kind=None):
+        """Return the events of given kind within the 16th note step."""
+        start = step * TICKS_PER_STEP
+        return self._events[self._variant].between(start,
+                                                   start + TICKS_PER_STEP,
+                                                   kind)
 
     def tranpose(self, semitones):
         """Transpose all note properties of the parts events."""
@@ -290,40 +860,15 @@ class Part(object):
             except:
                 pass
 
-    def _sort(self):
-        """Sort self._events. Calc self.element and self.next_timestamp."""
-        global running_time
-        if len(self._events[self._variant]) == 0:
-            self.start()
-            return
-        self._events[self._variant].sort()
-        # Calculate last element played
-        step_in_loop = running_time % self.length
-        self.element = len(self._events[self._variant]) - 1
-        for i, e in enumerate(self._events[self._variant]):
-            if e.timestamp < step_in_loop:
-                self.element = i
-        next_elmt = (self.element + 1) % len(self._events[self._variant])
-        self.next_timestamp = self._events[self._variant][next_elmt].timestamp
-        self.finished = False
-        if step_in_loop > self._events[self._variant][-1].timestamp:
-            self.finished = True
-
-    def _trigger_event(self):
-        """Trigger event(s). Update self.element. Check if finished."""
-        # trigger all events with the correct timestamp
-        play_elmt = (self.element + 1) % len(self._events[self._variant])
-        while(self._events[self._variant][play_elmt].timestamp ==
-              self.next_timestamp and not self.finished):
-            if not self.mute:
-                event = self._events[self._variant][play_elmt]
-                event.call(self)
-            self.element = play_elmt
-            if self.element == len(self._events[self._variant]) - 1:
-                self.finished = True
-            play_elmt = (self.element + 1) % len(self._events[self._variant])
-
-        self.next_timestamp = self._events[self._variant][play_elmt].timestamp
+    def _seek(self):
+        """Relocate the cursor after the events have changed."""
+        invalidate()
+        store = self._events[self._variant]
+        loop_tick = schedule_tick % self.length_ticks
+        if self.last_measure < 0:
+            self.cursor = store.index_at(loop_tick)
+        else:
+            self.cursor = store.index_after(loop_tick)
 
 
 # YAML Part representation
@@ -334,16 +879,17 @@ def part_representer(dumper, data):
                'bank': data.bank,
                'program': data.program,
                'cc': data.cc,
-               'events': data._events,
-               'variant': data._variant}
+               'events': [list(v) for v in data._events],
+               'variant': data._variant,
+               'port': data.port}
     return dumper.represent_mapping(u'!part', mapping)
 
 
 def part_constructor(loader, node):
-    m = loader.construct_mapping(node)
+    m = loader.construct_mapping(node, deep=True)
     return Part(m['name'], m['length'], m['channel'],
                 m['bank'], m['program'], m['cc'],
-                m['events'], m['variant'])
+                m['events'], m['variant'], m.get('port', 0))
 
 yaml.add_representer(Part, part_representer)
 yaml.add_constructor(u'!part', part_constructor)
@@ -0,0 +1,95 @@
+"""Timing accuracy of the MIDI output.
+
+For every timestamped message written to the MIDI out, the intended time
+(the timestamp) and the time it was actually written are recorded. The
+difference is how late the message was handed to PortMidi: negative values
+mean it was sent ahead of time, which is what the lookahead is for, and
+positive values mean it was late.
+
+The samples are kept per source (a part name, or 'clock') in rolling windows.
+"""
+
+from collections import deque
+
+import threading
+import time
+
+enabled = False
+WINDOW = 2000  # samples kept per source
+ALL = 'all'
+
+samples = {}
+# Samples are recorded by the threads writing to the MIDI out ports
+lock = threading.Lock()
+
+
+def record(source, intended, actual):
+    """Record a message meant for intended, written at actual (in ms)."""
+    if source is None:
+        source = 'other'
+    with lock:
+        window = samples.get(source)
+        if window is None:
+            window = samples[source] = deque(maxlen=WINDOW)
+        window.append(actual - intended)
+
+
+def clear():
+    with lock:
+        samples.clear()
+
+
+def percentile(ordered, p):
+    """The p:th percentile (0-100) of a sorted list."""
+    if not ordered:
+        return None
+    index = int(round((len(ordered) - 1) * p / 100.0))
+    return ordered[index]
+
+
+def stats(source=ALL):
+    """Return (count, p50, p99, max) of the lateness in ms for source.
+
+    The ALL source is the combination of all sources.
+    """
+    with lock:
+        if source == ALL:
+            values = [v for window in samples.values() for v in window]
+        else:
+            values = list(samples.get(source, ()))
+    values.sort()
+    if not values:
+        return (0, None, None, None)
+    return (len(values),
+            percentile(values, 50),
+            percentile(values, 99),
+            values[-1])
+
+
+def report():
+    """A list of text lines with the stats of each source."""
+    lines = ['{:<16} {:>6} {:>6} {:>6} {:>6}'.format('source', 'count',
+                                                      'p50', 'p99', 'max')]
+    with lock:
+        sources = sorted(samples)
+    for source in sources + [ALL]:
+        count, p50, p99, maximum = stats(source)
+        if count:
+            lines.append('{:<16} {:>6} {:>6} {:>6} {:>6}'.format(
+                source[:16], count, p50, p99, maximum))
+    return lines
+
+
+def dump(filename):
+    """Append the report, and all samples, to filename."""
+    with open(filename, 'a') as f:
+        f.write('# {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+        for line in report():
+            f.write(line + '\n')
+        with lock:
+            windows = [(source, list(samples[source]))
+                       for source in sorted(samples)]
+        for source, window in windows:
+            f.write('{}: {}\n'.format(source,
+                                      ' '.join(str(v) for v in window)))
+        f.write('\n')